@@ -1,7 +1,7 @@
 import asyncio
 import json
 import time
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
 
@@ -14,8 +14,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import Response
 from starlette.websockets import WebSocket
 
-from src.lib import adb
-from src.lib.android import take_screenshot_with_api, take_screenshots_with_api
+from src.lib import adb, android
+from src.lib.android import take_screenshot_with_api
 
 _mouse_events_handler = None
 _last_screenshot_timestamp = None
@@ -23,15 +23,17 @@ _last_screenshot_timestamp = None
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    # The socket client needs a running adb server, and unlike the adb binary it doesn't start one itself.
+    adb.start_server()
+    adb.forward_port(8080)
+
     handler = get_mouse_event_handler()
     await handler.start_task()
 
-    adb.forward_port(8080)
-    adb.start_server()
-
     yield
 
     await handler.stop_task()
+    await android.get_default_device().screenshot_client.close()
 
 
 @dataclass
@@ -129,8 +131,8 @@ app.add_middleware(
 
 
 @app.get('/api/v1/images/latest')
-def get_image():
-    screenshot = take_screenshot_with_api()
+async def get_image():
+    screenshot = await take_screenshot_with_api()
     _, buffer = cv2.imencode('.jpeg', screenshot)
     return Response(
         content=buffer.tobytes(),
@@ -144,13 +146,17 @@ async def ws_image_stream(websocket: WebSocket):
 
     await websocket.accept()
 
-    async for screenshot in take_screenshots_with_api():
-        if _last_screenshot_timestamp is None or time.time() - _last_screenshot_timestamp > 12:
-            _last_screenshot_timestamp = time.time()
-            cv2.imwrite(f'local/screenshots/{_last_screenshot_timestamp}.jpg', screenshot)
+    # Every connected viewer shares the device's one capture loop.
+    async with aclosing(android.subscribe_frames()) as frames:
+        async for frame in frames:
+            screenshot = await frame.decode_async()
+
+            if _last_screenshot_timestamp is None or time.time() - _last_screenshot_timestamp > 12:
+                _last_screenshot_timestamp = time.time()
+                cv2.imwrite(f'local/screenshots/{_last_screenshot_timestamp}.jpg', screenshot)
 
-        _, buffer = cv2.imencode('.jpeg', screenshot)
-        await websocket.send_bytes(buffer.tobytes())
+            _, buffer = cv2.imencode('.jpeg', screenshot)
+            await websocket.send_bytes(buffer.tobytes())
 
 
 @app.websocket('/api/v1/ws/mouse-state')
@@ -163,6 +169,19 @@ async def ws_mouse_state(websocket: WebSocket):
         handler.add_events(data)
 
 
+@app.get('/metrics')
+def get_metrics():
+    return Response(
+        content=adb.render_metrics(),
+        media_type='text/plain; version=0.0.4'
+    )
+
+
+@app.get('/api/v1/metrics')
+def get_metrics_snapshot():
+    return adb.get_metrics_snapshot()
+
+
 @app.get('/api/v1/images/clicks-and-drags-overlay')
 def get_clicks_and_drags_overlay():
     path = Path('clicks_and_drags_overlay.png')
@@ -10,6 +10,7 @@ import dotenv
 import matplotlib.pyplot as plt
 import numpy as np
 
+from src.bots.hay_day import templates
 from src.bots.hay_day.client import HayDayClient
 from src.lib import adb, android
 
@@ -26,8 +27,8 @@ SEGMENT_ASSOCIATIONS_BY_INDEX = [
 ]
 
 
-def get_events():
-    file = Path('local/events/events_1712080057.txt')
+def get_events(path: str | Path = 'local/events/events_1712080057.txt'):
+    file = Path(path)
     events = []
 
     for line in file.read_text().splitlines():
@@ -367,53 +368,49 @@ async def run(label: str):
                 await asyncio.sleep(random.uniform(*delay_between_events), 3)
 
 
-async def sell_all_pending_wheat():
+async def sell_all_pending_wheat(device: android.AndroidDevice = None):
     """
     - Check color of plus signs
     - Use memory to store the state of the device without needing to constantly check screenshots.
     """
-    client = HayDayClient('farm')
+    device = device or android.get_default_device()
+    client = HayDayClient('farm', device)
 
+    # Each step waits for the template it acts on, or for a region without the animated background to settle.
     await client.farm.click_roadside_shop()
-    await asyncio.sleep(.2)
 
     has_wheat_left = True
 
     async for slot in client.roadside_shop.iterate_slots(slot_types=['sold', 'open']):
         if slot.type == 'sold':
-            await android.tap(*slot.rectangle.center)
-            await asyncio.sleep(.15)
+            await device.tap(*slot.rectangle.center)
+            await device.wait_for_stable_frame(tuple(slot.rectangle))
             continue
 
         if slot.type == 'open':
             if not has_wheat_left:
                 continue
 
-            await android.tap(*slot.rectangle.center)
-            await asyncio.sleep(.5)
+            await device.tap(*slot.rectangle.center)
+            await client.roadside_shop.sale_preview.wait_until_open()
 
             if not await client.roadside_shop.sale_preview.is_wheat_icon_visible():
                 has_wheat_left = False
                 await client.roadside_shop.click_x_button()
-                await asyncio.sleep(.5)
+                await client.roadside_shop.sale_preview.wait_until_closed()
                 continue
 
             await client.roadside_shop.sale_preview.click_wheat_icon()
             await client.roadside_shop.sale_preview.click_quantity_plus_button(5)
             await client.roadside_shop.sale_preview.click_price_plus_max_button()
             await client.roadside_shop.sale_preview.click_put_on_sale_button()
-            await asyncio.sleep(.5)
+            await client.roadside_shop.sale_preview.wait_until_closed()
 
     async for slot in client.roadside_shop.iterate_slots(slot_types=['occupied_by_wheat'], reverse=True):
         if slot.type == 'occupied_by_wheat':
-            await android.tap(*slot.rectangle.center)
-            await asyncio.sleep(.5)
-
+            await device.tap(*slot.rectangle.center)
             await client.roadside_shop.click_advertise_now_button()
-            await asyncio.sleep(.5)
-
             await client.roadside_shop.click_create_advertisement_button()
-            await asyncio.sleep(.5)
 
             break
 
@@ -421,6 +418,8 @@ async def sell_all_pending_wheat():
 
 
 async def run_async():
+    templates.preload()
+
     while True:
         await run('plant_crops')
         start = time.time()
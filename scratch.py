@@ -11,7 +11,6 @@ import numpy as np
 from src.bots.hay_day import templates
 from src.bots.hay_day.client import HayDayClient
 from src.lib import android, vision
-from src.lib.vision import Rectangle
 
 
 @dataclass
@@ -141,8 +140,7 @@ async def main_v1():
         threshold=0.9
     )
 
-    rectangles = [(tl[0], tl[1], br[0] - tl[0], br[1] - tl[1]) for tl, br in matches]
-    rectangles, _ = cv2.groupRectangles(rectangles, groupThreshold=1, eps=0.2)
+    rectangles = list(templates.merge_matches(matches))
 
     for (x, y, w, h) in rectangles:
         cv2.rectangle(canvas, (x, y), (x + w, y + h), (0, 255, 0), 2)
@@ -208,12 +206,10 @@ async def get_current_state():
         )
     )).flatten()
 
-    rectangles = [tuple(match.rectangle) for match in matches]
-    rectangles, _ = cv2.groupRectangles(rectangles, groupThreshold=1, eps=0.2)
+    rectangles = list(templates.merge_matches(matches))
 
     assert len(rectangles) == 2, 'Expected 2 plus signs'
 
-    rectangles = [Rectangle(*rectangle) for rectangle in rectangles]
     rectangles.sort(key=lambda rect: rect.y)
 
     plus_colors = detect_colors(
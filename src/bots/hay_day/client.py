@@ -1,14 +1,12 @@
-import asyncio
 from dataclasses import dataclass, field
+from functools import partial
 from typing import Literal
 
-import cv2
-
 from src.bots.hay_day import templates
 from src.bots.hay_day.templates import merge_rectangles
-from src.lib import android
+from src.lib import android, vision
 from src.lib.commons import flatten
-from src.lib.vision import Rectangle
+from src.lib.vision import Rectangle, any_of, expect
 
 
 SlotType = Literal[
@@ -17,10 +15,32 @@ SlotType = Literal[
     'occupied_by_wheat'
 ]
 
+# Buttons are searched for in a region of a layout that is found first. Regions are (x, y, w, h) offsets from the
+# layout's top left with some margin, measured with the layout templates at their original size.
+SHOP_X_BUTTON_REGION = (1074, -1, 181, 180)
+
+SALE_PREVIEW_X_BUTTON_REGION = (1040, -17, 181, 180)
+SALE_PREVIEW_PLUS_BUTTONS_REGION = (996, 144, 160, 265)
+SALE_PREVIEW_PLUS_MAX_BUTTON_REGION = (932, 350, 139, 138)
+SALE_PREVIEW_PUT_ON_SALE_BUTTON_REGION = (610, 674, 619, 156)
+SALE_PREVIEW_ITEMS_REGION = (142, 110, 538, 680)
+
+
+def get_region(anchor: Rectangle, region: tuple[int, int, int, int], path: str) -> Rectangle:
+    """
+    Place a region next to an anchor as it was matched, scaled by how much larger or smaller the anchor is than its
+    template at `path`.
+    """
+    scale = anchor.w / vision.get_template(path).size[0]
+    x, y, w, h = (round(value * scale) for value in region)
+
+    return vision.get_roi(x, y, w, h, anchor=anchor)
+
 
 @dataclass
 class HayDayClient:
     current_view: str
+    device: android.AndroidDevice = field(default_factory=android.get_default_device)
 
     farm: 'Farm' = field(init=False)
     roadside_shop: 'RoadsideShop' = field(init=False)
@@ -34,19 +54,12 @@ class HayDayClient:
 class Farm:
     client: 'HayDayClient'
 
-    @staticmethod
-    async def click_roadside_shop():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        rects = templates.match_roadside_shop(image)
-        rects = list(rects)
-
-        assert len(rects) == 1
-
-        match = rects[0]
+    async def click_roadside_shop(self):
+        match, = await self.client.device.wait_until(
+            expect(templates.match_roadside_shop)
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
@@ -68,78 +81,57 @@ class RoadsideShop:
     def __post_init__(self):
         self.sale_preview = SalePreview(self.client)
 
-    @staticmethod
-    async def click_x_button():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    async def click_x_button(self):
+        # The button closes the sale preview when it is open, and the shop otherwise.
+        found, (anchor,) = await self.client.device.wait_until(
+            any_of(
+                expect(templates.match_roadside_shop_sale_preview_layout),
+                expect(templates.match_roadside_shop_layout)
+            )
+        )
 
-        rects = templates.match_x_button(image)
-        rects = list(rects)
+        if found == 0:
+            region = get_region(anchor, SALE_PREVIEW_X_BUTTON_REGION, templates.ROADSIDE_SHOP_SALE_PREVIEW_LAYOUT)
 
-        assert len(rects) == 1
+        else:
+            region = get_region(anchor, SHOP_X_BUTTON_REGION, templates.ROADSIDE_SHOP_LAYOUT)
 
-        match = rects[0]
+        match, = await self.client.device.wait_until(
+            expect(partial(templates.match_x_button, roi=region))
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
 
-    @staticmethod
-    async def click_advertise_now_button():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        rects = templates.match_roadside_shop_advertise_now_text(image)
-        rects = list(rects)
-
-        assert len(rects) == 1
-
-        rect = rects[0]
+    async def click_advertise_now_button(self):
+        rect, = await self.client.device.wait_until(
+            expect(templates.match_roadside_shop_advertise_now_text)
+        )
 
         x = rect.bottom_right.x + 40
         y = rect.center.y
 
-        await android.tap(x, y)
-
-    @staticmethod
-    async def click_create_advertisement_button():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        rects = templates.create_advertisement_button(image)
-        rects = list(rects)
-
-        assert len(rects) == 1
+        await self.client.device.tap(x, y)
 
-        rect = rects[0]
+    async def click_create_advertisement_button(self):
+        rect, = await self.client.device.wait_until(
+            expect(templates.create_advertisement_button)
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             rect.center.x,
             rect.center.y
         )
 
-    @staticmethod
-    async def scroll_through_shop(reverse: bool = False):
+    async def scroll_through_shop(self, reverse: bool = False):
         direction = 'backward' if reverse else 'forward'
 
         while True:
-            image_bgr = await android.take_screenshot_with_api()
-            image = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2GRAY)
-
-            layout = templates.match_roadside_shop_layout(image)
-            layout = next(layout, None)
-
-            assert layout, 'Could not find layout while attempting to scroll through shop.'
-
-            yield image_bgr
-
-            if direction == 'forward':
-                purchase_new_slot = templates.match_purchase_new_roadside_shop_slot(image)
-                purchase_new_slot = next(purchase_new_slot, None)
-
-                if purchase_new_slot:
-                    break
+            layout, *_ = await self.client.device.wait_until(
+                expect(templates.match_roadside_shop_layout, count=None)
+            )
 
             padding = 180
 
@@ -151,6 +143,21 @@ class RoadsideShop:
             x2 -= padding
             y2 -= padding
 
+            # Slots are matched once the shop has stopped scrolling. The frame caches its crop of the layout, which
+            # every slot matcher below searches in.
+            settled = await self.client.device.wait_for_stable_frame((x1, y1, x2 - x1, y2 - y1))
+            frame = await settled.to_frame('gray')
+
+            yield frame, layout
+
+            if direction == 'forward':
+                with vision.use_calibration(self.client.device.scale_calibration):
+                    purchase_new_slot = templates.match_purchase_new_roadside_shop_slot(frame, roi=layout)
+                    purchase_new_slot = next(purchase_new_slot, None)
+
+                if purchase_new_slot:
+                    break
+
             start_x = x2
             start_y = (y1 + y2) // 2
 
@@ -173,13 +180,7 @@ class RoadsideShop:
             else:
                 points = sorted(points, key=lambda p: p[0])
 
-            await android.press(points[0][0], points[0][1])
-
-            for point in points[1:-1]:
-                await android.move(point[0], point[1])
-
-            await android.release(points[-1][0], points[-1][1])
-            await asyncio.sleep(.33)
+            await self.client.device.gesture(points, timings=.01)
 
     async def iterate_slots(self, slot_types: list[SlotType] = None, reverse: bool = False):
         match_fns = {
@@ -188,14 +189,14 @@ class RoadsideShop:
             'occupied_by_wheat': templates.match_roadside_shop_occupied_by_wheat,
         }
 
-        async for _ in self.scroll_through_shop(reverse=reverse):
-            for slot_type in slot_types:
-                image = await android.take_screenshot_with_api()
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-                match_fn = match_fns[slot_type]
-                rects = match_fn(image)
+        async for frame, layout in self.scroll_through_shop(reverse=reverse):
+            with vision.use_calibration(self.client.device.scale_calibration):
+                results = await vision.match_many_async(frame, {
+                    slot_type: partial(match_fns[slot_type], roi=layout)
+                    for slot_type in slot_types
+                })
 
+            for slot_type, rects in results.items():
                 for rect in rects:
                     yield RoadsideShopSlot(
                         slot_type,
@@ -207,116 +208,117 @@ class RoadsideShop:
 class SalePreview:
     client: 'HayDayClient'
 
-    @staticmethod
-    async def ensure_silo_inventory_is_toggled():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    async def wait_until_open(self) -> Rectangle:
+        """
+        Wait for the dialog to open and stop moving, and return its layout.
+        """
+        layout, = await self.client.device.wait_until(
+            expect(templates.match_roadside_shop_sale_preview_layout)
+        )
 
-        rects = templates.match_roadside_shop_silo_storage_text(image)
-        rects = list(rects)
+        await self.client.device.wait_for_stable_frame(tuple(layout))
 
-        if len(rects) == 1:
-            return
+        return layout
 
-        rects = templates.match_roadside_shop_sale_preview_silo_icon(image)
-        rects = list(rects)
+    async def wait_until_closed(self):
+        await self.client.device.wait_until(
+            expect(templates.match_roadside_shop_sale_preview_layout, count=0)
+        )
 
-        assert len(rects) == 1
+    async def ensure_silo_inventory_is_toggled(self):
+        found, (match,) = await self.client.device.wait_until(
+            any_of(
+                expect(templates.match_roadside_shop_silo_storage_text),
+                expect(templates.match_roadside_shop_sale_preview_silo_icon)
+            )
+        )
 
-        match = rects[0]
+        if found == 0:
+            return
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
 
-    @staticmethod
-    async def click_wheat_icon():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        rects = templates.match_roadside_shop_sale_preview_wheat_icon(image)
-        rects = list(rects)
-
-        assert len(rects) == 1
-
-        match = rects[0]
+    async def click_wheat_icon(self):
+        match, = await self.client.device.wait_until(
+            expect(templates.match_roadside_shop_sale_preview_wheat_icon)
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
 
-    @staticmethod
-    async def click_price_plus_max_button():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    async def get_region(self, region: tuple[int, int, int, int]) -> Rectangle:
+        """
+        Find a region of the dialog from its layout, which doesn't depend on the inventory that is shown.
+        """
+        anchor, = await self.client.device.wait_until(
+            expect(templates.match_roadside_shop_sale_preview_layout)
+        )
 
-        rects = templates.match_roadside_shop_sale_preview_plus_max_button(image)
-        rects = list(rects)
+        return get_region(anchor, region, templates.ROADSIDE_SHOP_SALE_PREVIEW_LAYOUT)
 
-        assert len(rects) == 1
+    async def click_price_plus_max_button(self):
+        region = await self.get_region(SALE_PREVIEW_PLUS_MAX_BUTTON_REGION)
 
-        match = rects[0]
+        match, = await self.client.device.wait_until(
+            expect(partial(templates.match_roadside_shop_sale_preview_plus_max_button, roi=region))
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
 
-    @staticmethod
-    async def click_put_on_sale_button():
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        rects = templates.match_roadside_shop_sale_preview_put_on_sale_button(image)
-        rects = list(rects)
-
-        assert len(rects) == 1
+    async def click_put_on_sale_button(self):
+        region = await self.get_region(SALE_PREVIEW_PUT_ON_SALE_BUTTON_REGION)
 
-        match = rects[0]
+        match, = await self.client.device.wait_until(
+            expect(partial(templates.match_roadside_shop_sale_preview_put_on_sale_button, roi=region))
+        )
 
-        await android.tap(
+        await self.client.device.tap(
             match.center.x,
             match.center.y,
         )
 
-    @staticmethod
-    async def click_quantity_plus_button(times: int):
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    async def click_quantity_plus_button(self, times: int):
+        # The quantity and price plus buttons, without the minus buttons that look just like them.
+        region = await self.get_region(SALE_PREVIEW_PLUS_BUTTONS_REGION)
 
-        rects = list(
-            merge_rectangles(
+        def match_plus_buttons(image):
+            return merge_rectangles(
                 flatten([
-                    templates.match_roadside_shop_sale_preview_plus_icon(image),
-                    templates.match_roadside_shop_sale_preview_plus_disabled_icon(image)
+                    templates.match_roadside_shop_sale_preview_plus_icon(image, roi=region),
+                    templates.match_roadside_shop_sale_preview_plus_disabled_icon(image, roi=region)
                 ])
             )
-        )
-
-        rects = sorted(rects, key=lambda r: r.center.y)
-
-        assert len(rects) == 2
 
-        quantity_plus = rects[0]
+        rects = await self.client.device.wait_until(
+            expect(match_plus_buttons, count=2)
+        )
 
-        for _ in range(times):
-            await android.tap(
-                quantity_plus.center.x,
-                quantity_plus.center.y,
-            )
+        quantity_plus = min(rects, key=lambda r: r.center.y)
 
-            await asyncio.sleep(.1)
+        await self.client.device.multi_tap(
+            quantity_plus.center.x,
+            quantity_plus.center.y,
+            times=times,
+            interval=.1
+        )
 
     async def is_wheat_icon_visible(self):
         await self.ensure_silo_inventory_is_toggled()
-        await asyncio.sleep(1)
 
-        image = await android.take_screenshot_with_api()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        region = await self.get_region(SALE_PREVIEW_ITEMS_REGION)
+        settled = await self.client.device.wait_for_stable_frame(tuple(region))
+        frame = await settled.to_frame('gray')
 
-        rects = templates.match_roadside_shop_sale_preview_wheat_icon(image)
-        rects = list(rects)
+        with vision.use_calibration(self.client.device.scale_calibration):
+            rects = templates.match_roadside_shop_sale_preview_wheat_icon(frame, roi=region)
+            rects = list(rects)
 
         return len(rects) == 1
@@ -1,15 +1,59 @@
 import asyncio
+import json
+import os
+import signal
+import struct
 import subprocess
+import threading
 import time
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Literal
 
-from src.lib.env import get_adb_alias, get_adb_exe_dir
+import cv2
+import numpy as np
+
+from src.lib.adb_dispatch import InputDispatcher
+from src.lib.adb_metrics import metrics
+from src.lib.adb_protocol import AdbClient
+from src.lib.adb_shell import ShellResult, ShellSession, ShellSessionPool
+from src.lib.adb_touch import (
+    GeteventParser,
+    TouchAction,
+    TouchEvent,
+    TouchScreen,
+    compile_motionevents,
+    parse_touchscreen
+)
+from src.lib.commons import PerLoop
+from src.lib.env import (
+    get_adb_alias,
+    get_adb_exe_dir,
+    get_adb_serial,
+    get_adb_server_port,
+    get_adb_shell_pool_size,
+    get_adb_shell_timeout,
+    get_adb_touch_backend
+)
 
 from enum import Enum
 
 ADB_ALIAS = get_adb_alias()
 
+_default_device: 'AdbDevice | None' = None
+
+# screencap pixel formats (android.graphics.PixelFormat / HAL formats) mapped to bytes per pixel and the conversion to
+# OpenCV's BGR(A) channel order.
+_FRAMEBUFFER_FORMATS = {
+    1: (4, cv2.COLOR_RGBA2BGRA),  # RGBA_8888
+    2: (4, cv2.COLOR_RGBA2BGRA),  # RGBX_8888
+    3: (3, cv2.COLOR_RGB2BGR),  # RGB_888
+    5: (4, None),  # BGRA_8888
+}
+
+_sync_loop: asyncio.AbstractEventLoop | None = None
+_sync_loop_lock = threading.Lock()
+
 
 class KeyCodes(Enum):
     POWER = 'KEYCODE_POWER'
@@ -34,84 +78,572 @@ class WakefulnessStates(Enum):
         raise ValueError(f'Invalid wakefulness state: {string}')
 
 
+@dataclass
+class AdbDevice:
+    """
+    A single device behind the adb server, with its own client and shell session pools. Create one per serial to
+    drive several devices from one process.
+    """
+    serial: str | None = None
+    port: int = field(default_factory=get_adb_server_port)
+    shell_pool_size: int = field(default_factory=get_adb_shell_pool_size)
+
+    # Seconds a pooled shell command may run before its session is dropped, so a hung command can't hold a session.
+    shell_timeout: float | None = field(default_factory=get_adb_shell_timeout)
+
+    client: AdbClient = field(init=False)
+
+    # time.monotonic() after the most recent touch events were sent, so frames can be required to show their effect.
+    last_input_at: float = field(default=0, init=False)
+
+    # Sessions wrap loop-bound sockets and dispatchers run loop-bound tasks, so every event loop gets its own.
+    _shell_pools: PerLoop[ShellSessionPool] = field(init=False, repr=False)
+    _input_dispatchers: PerLoop[dict[str, InputDispatcher]] = field(init=False, repr=False)
+    _touchscreen: TouchScreen | None = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self.client = AdbClient(
+            serial=self.serial,
+            port=self.port
+        )
+        self._shell_pools = PerLoop(self._create_shell_pool)
+        self._input_dispatchers = PerLoop(dict)
+
+    def screencap(self, path: str = None):
+        path = path or './temp/screenshot.png'
+        path = Path(path).resolve()
+        path.parent.mkdir(
+            parents=True,
+            exist_ok=True
+        )
+        with metrics.track('screencap', self.serial):
+            path.write_bytes(_run_sync(self.client.exec('screencap -p')))
+
+        return path
+
+    def screencap_raw(self) -> np.ndarray:
+        return _run_sync(self.screencap_raw_async())
+
+    async def screencap_raw_async(self) -> np.ndarray:
+        """
+        Capture the screen without PNG encoding by streaming raw `screencap` output straight into an array.
+        """
+        with metrics.track('screencap_raw', self.serial):
+            connection = await self.client.open('exec:screencap')
+
+            try:
+                return await _read_framebuffer(connection.reader)
+
+            finally:
+                await connection.close()
+
+    def swipe(self, x1: int, y1: int, x2: int, y2: int, duration: int = 100):
+        self.shell(f'input swipe {x1} {y1} {x2} {y2} {duration}')
+
+    def tap(self, x: int, y: int):
+        self.shell(f'input tap {x} {y}')
+
+    async def motionevent(
+            self,
+            name: TouchAction,
+            x: int,
+            y: int,
+            do_async: bool = True,
+            backend: Literal['input', 'sendevent'] = None
+    ):
+        return await self.motionevents(
+            [TouchEvent(name, x, y)],
+            do_async=do_async,
+            backend=backend
+        )
+
+    async def motionevents(
+            self,
+            events: list[TouchEvent],
+            do_async: bool = True,
+            backend: Literal['input', 'sendevent'] = None
+    ):
+        """
+        Inject a sequence of touch events as a single shell script, so the whole sequence costs one round-trip.
+
+        The 'input' backend starts the Android `input` tool for every event, while 'sendevent' writes raw events to
+        the touchscreen device node. When `do_async` is False the events are handed to the device's input dispatcher,
+        which keeps them in order, and this returns as soon as they are queued.
+        """
+        backend = backend or get_adb_touch_backend()
+
+        if not do_async:
+            dispatcher = self.get_input_dispatcher(backend)
+
+            for event in events:
+                await dispatcher.submit(event)
+
+            return
+
+        with metrics.track('motionevent', self.serial):
+            return await self._motionevents(events, backend)
+
+    def get_input_dispatcher(self, backend: Literal['input', 'sendevent'] = None) -> InputDispatcher:
+        backend = backend or get_adb_touch_backend()
+        dispatchers = self._input_dispatchers.get()
+
+        if backend not in dispatchers:
+            dispatchers[backend] = InputDispatcher(
+                send=lambda events: self.motionevents(events, backend=backend)
+            )
+
+        return dispatchers[backend]
+
+    async def _motionevents(self, events: list[TouchEvent], backend: str):
+        if backend == 'sendevent':
+            touchscreen = await self.get_touchscreen()
+            script = touchscreen.compile(events)
+
+        elif backend == 'input':
+            script = compile_motionevents(events)
+
+        else:
+            raise ValueError(f'Invalid touch backend: {backend}')
+
+        result = await self.shell_async(script)
+        self.last_input_at = time.monotonic()
+
+        return result
+
+    async def get_touchscreen(self, refresh: bool = False) -> TouchScreen:
+        if self._touchscreen is None or refresh:
+            getevent_output, wm_size_output, dumpsys_input_output = await asyncio.gather(
+                self.shell_async('getevent -pl'),
+                self.shell_async('wm size'),
+                self.shell_async('dumpsys input | grep -E "SurfaceOrientation|orientation=" || true'),
+            )
+
+            self._touchscreen = parse_touchscreen(
+                getevent_output.decode(),
+                wm_size_output.decode(),
+                dumpsys_input_output.decode()
+            )
+
+        return self._touchscreen
+
+    async def stream(
+            self,
+            command: str,
+            chunk_size: int = 2 ** 16,
+            service: Literal['exec', 'shell'] = 'exec'
+    ):
+        """
+        Run a command and yield its stdout in chunks of at most `chunk_size` bytes as it is produced. Only a couple of
+        chunks are ever buffered on the host; a slow consumer makes the device wait instead of growing memory.
+        """
+        with metrics.track('stream', self.serial):
+            connection = await self.client.open(f'{service}:{command}', limit=chunk_size)
+
+            try:
+                while chunk := await connection.reader.read(chunk_size):
+                    yield chunk
+
+            finally:
+                await connection.close()
+
+    async def stream_lines(
+            self,
+            command: str,
+            max_line_length: int = 2 ** 16,
+            service: Literal['exec', 'shell'] = 'exec'
+    ):
+        """
+        Run a command and yield its stdout line by line, without line endings. Lines longer than `max_line_length` are
+        yielded in pieces so memory stays bounded.
+        """
+        buffer = bytearray()
+
+        async for chunk in self.stream(command, service=service):
+            buffer += chunk
+            start = 0
+
+            while (end := buffer.find(b'\n', start)) != -1:
+                yield bytes(buffer[start:end]).rstrip(b'\r')
+                start = end + 1
+
+            del buffer[:start]
+
+            while len(buffer) > max_line_length:
+                yield bytes(buffer[:max_line_length])
+                del buffer[:max_line_length]
+
+        if buffer:
+            yield bytes(buffer).rstrip(b'\r')
+
+    async def iter_touches(self):
+        """
+        Stream touches made on the device itself as mousedown/mousemove/mouseup events with kernel timestamps.
+        """
+        touchscreen = await self.get_touchscreen()
+        parser = GeteventParser(touchscreen)
+
+        # `shell:` runs getevent on a pty, so it flushes every line instead of buffering a pipe's worth of output.
+        async for line in self.stream_lines(f'getevent -lt {touchscreen.path}', service='shell'):
+            for event in parser.feed(line.decode(errors='replace')):
+                yield event
+
+    async def record_touches(self, path: str | Path = None) -> Path:
+        """
+        Record touches until cancelled, appending one JSON list of events per gesture to `path` in the same format as
+        the browser recordings in local/events.
+        """
+        path = Path(path or f'local/events/events_{int(time.time())}.txt')
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        events = []
+
+        def flush():
+            if events:
+                with path.open('a') as f:
+                    f.write(json.dumps(events) + '\n')
+
+                events.clear()
+
+        try:
+            async for event in self.iter_touches():
+                events.append(event)
+
+                if event['type'] == 'mouseup':
+                    flush()
+
+        finally:
+            flush()
+
+        return path
+
+    def press_power_button(self):
+        self.shell('input keyevent 26')
+
+    def get_wakefulness_state(self):
+        state = self.shell('dumpsys power | grep "mWakefulness="')
+        state = state.decode().split('=')[1].strip()
+
+        return WakefulnessStates.from_string(state)
+
+    def forward_port(self, port: int, remote_port: int = None):
+        with metrics.track('forward', self.serial):
+            _run_sync(self.client.forward(f'tcp:{port}', f'tcp:{remote_port or port}'))
+
+    def turn_on(self, passcode: str = None):
+        state = self.get_wakefulness_state()
+
+        if state == WakefulnessStates.ASLEEP:
+            self.press_power_button()
+
+        elif state == WakefulnessStates.DREAMING or state == WakefulnessStates.DOZING:
+            self.tap(100, 100)
+
+        elif state == WakefulnessStates.AWAKE:
+            pass
+
+        else:
+            raise Exception(f'Invalid wakefulness state: {state}')
+
+        time.sleep(2)
+
+        self.swipe(100, 100, 500, 500)
+
+        if passcode:
+            for digit in passcode:
+                self.shell(f'input text {digit}')
+
+        self.shell('input keyevent 66')
+
+        return self.get_wakefulness_state()
+
+    def shell(self, command: str, check_error: bool = True) -> bytes:
+        """
+        Run a command on the device through a pooled, long-lived shell session.
+        """
+        return _run_sync(self.shell_async(command, check_error))
+
+    async def shell_async(self, command: str, check_error: bool = True) -> bytes:
+        """
+        Run a command on the device through a pooled, long-lived shell session and return its stdout; stderr is kept
+        apart, see `execute`. When `check_error` is False a failing command returns its output instead of raising.
+        """
+        result = await self._execute(command, check_error)
+        return result.stdout
+
+    def execute(self, command: str, check_error: bool = True) -> ShellResult:
+        """
+        Run a command like `shell`, but return its exit code and stderr as well as its stdout.
+        """
+        return _run_sync(self.execute_async(command, check_error))
+
+    async def execute_async(self, command: str, check_error: bool = True) -> ShellResult:
+        return await self._execute(command, check_error)
+
+    async def _execute(self, command: str, check_error: bool = True, timeout: float = None) -> ShellResult:
+        with metrics.track('shell', self.serial):
+            return await self._get_shell_pool().execute(
+                command,
+                check_error,
+                self.shell_timeout if timeout is None else timeout
+            )
+
+    def close(self):
+        dispatchers_by_loop = dict(self._input_dispatchers.items())
+
+        for loop, pool in self._shell_pools.items():
+            dispatchers = dispatchers_by_loop.get(loop, {})
+            _close_on_loop(loop, *(dispatcher.close() for dispatcher in dispatchers.values()), pool.close())
+
+    def _get_shell_pool(self) -> ShellSessionPool:
+        return self._shell_pools.get()
+
+    def _create_shell_pool(self) -> ShellSessionPool:
+        return ShellSessionPool(
+            # `exec:` gives a plain pipe to a non-interactive sh, unlike `shell:` which allocates a pty.
+            factory=lambda: ShellSession(opener=lambda: self.client.open('exec:sh')),
+            size=self.shell_pool_size
+        )
+
+
+def get_default_device() -> AdbDevice:
+    global _default_device
+
+    if _default_device is None:
+        _default_device = AdbDevice(serial=get_adb_serial())
+
+    return _default_device
+
+
+def list_devices() -> list[AdbDevice]:
+    devices = _run_sync(get_default_device().client.devices())
+
+    return [
+        AdbDevice(serial=serial)
+        for serial, state in devices
+        if state == 'device'
+    ]
+
+
+def get_client() -> AdbClient:
+    return get_default_device().client
+
+
 def screencap(path: str = None):
-    path = path or './temp/screenshot.png'
-    path = Path(path).resolve()
-    path.parent.mkdir(
-        parents=True,
-        exist_ok=True
-    )
-    execute_command(f'{ADB_ALIAS} exec-out screencap -p > {path}')
-    return path
+    return get_default_device().screencap(path)
+
+
+def screencap_raw() -> np.ndarray:
+    return get_default_device().screencap_raw()
+
+
+async def screencap_raw_async() -> np.ndarray:
+    return await get_default_device().screencap_raw_async()
 
 
 def swipe(x1: int, y1: int, x2: int, y2: int, duration: int = 100):
-    execute_command(f'{ADB_ALIAS} shell input swipe {x1} {y1} {x2} {y2} {duration}')
+    get_default_device().swipe(x1, y1, x2, y2, duration)
 
 
 def tap(x: int, y: int):
-    execute_command(f'{ADB_ALIAS} shell input tap {x} {y}')
+    get_default_device().tap(x, y)
 
 
-async def motionevent(name: Literal['down', 'up', 'move', 'cancel'], x: int, y: int, do_async: bool = True):
-    name = name.upper()
-    return await execute_command_async(
-        command=f'{ADB_ALIAS} shell input motionevent {name} {x} {y}',
-        check_error=do_async
-    )
+async def motionevent(
+        name: TouchAction,
+        x: int,
+        y: int,
+        do_async: bool = True,
+        backend: Literal['input', 'sendevent'] = None
+):
+    return await get_default_device().motionevent(name, x, y, do_async, backend)
+
+
+async def motionevents(
+        events: list[TouchEvent],
+        do_async: bool = True,
+        backend: Literal['input', 'sendevent'] = None
+):
+    return await get_default_device().motionevents(events, do_async, backend)
+
+
+async def get_touchscreen(refresh: bool = False) -> TouchScreen:
+    return await get_default_device().get_touchscreen(refresh)
+
+
+async def stream(command: str, chunk_size: int = 2 ** 16, service: Literal['exec', 'shell'] = 'exec'):
+    async for chunk in get_default_device().stream(command, chunk_size, service):
+        yield chunk
+
+
+async def stream_lines(command: str, max_line_length: int = 2 ** 16, service: Literal['exec', 'shell'] = 'exec'):
+    async for line in get_default_device().stream_lines(command, max_line_length, service):
+        yield line
+
+
+async def iter_touches():
+    async for event in get_default_device().iter_touches():
+        yield event
+
+
+async def record_touches(path: str | Path = None) -> Path:
+    return await get_default_device().record_touches(path)
 
 
 def press_power_button():
-    execute_command(f'{ADB_ALIAS} shell input keyevent 26')
+    get_default_device().press_power_button()
 
 
 def get_wakefulness_state():
-    state = execute_command(f'{ADB_ALIAS} shell dumpsys power | grep "mWakefulness="')
-    state = state.decode().split('=')[1].strip()
+    return get_default_device().get_wakefulness_state()
 
-    return WakefulnessStates.from_string(state)
 
-
-def forward_port(port: int):
-    execute_command(f'{ADB_ALIAS} forward tcp:{port} tcp:{port}')
+def forward_port(port: int, remote_port: int = None):
+    get_default_device().forward_port(port, remote_port)
 
 
 def start_server():
+    # The server is what the wire protocol talks to, so starting it is the one thing that still needs the binary.
     execute_command(f'{ADB_ALIAS} start-server')
 
 
 def turn_on(passcode: str = None):
-    state = get_wakefulness_state()
+    return get_default_device().turn_on(passcode)
+
+
+def shell(command: str, check_error: bool = True) -> bytes:
+    return get_default_device().shell(command, check_error)
+
+
+async def shell_async(command: str, check_error: bool = True) -> bytes:
+    return await get_default_device().shell_async(command, check_error)
+
+
+def close_shell_sessions():
+    get_default_device().close()
+
+
+def get_metrics_snapshot() -> dict:
+    """
+    Latency histograms, error counts and in-flight gauges for every adb command kind, grouped by device.
+    """
+    return metrics.snapshot()
+
+
+def render_metrics() -> str:
+    return metrics.render_prometheus()
+
+
+async def _read_framebuffer(reader: asyncio.StreamReader) -> np.ndarray:
+    header = await reader.readexactly(12)
+    width, height, pixel_format = struct.unpack('<III', header)
+
+    if pixel_format not in _FRAMEBUFFER_FORMATS:
+        raise Exception(f'Unsupported screencap pixel format: {pixel_format}')
+
+    bytes_per_pixel, conversion = _FRAMEBUFFER_FORMATS[pixel_format]
+    size = width * height * bytes_per_pixel
+
+    # Android 8+ appends a 4 byte color space to the header. Whether it is present is only known once the stream
+    # ends, so leave room for it and pick the right offset afterwards.
+    buffer = np.empty(size + 4, np.uint8)
+    view = memoryview(buffer)
+    received = 0
+
+    while received < len(buffer):
+        chunk = await reader.read(len(buffer) - received)
+
+        if not chunk:
+            break
 
-    if state == WakefulnessStates.ASLEEP:
-        press_power_button()
+        view[received:received + len(chunk)] = chunk
+        received += len(chunk)
 
-    elif state == WakefulnessStates.DREAMING or state == WakefulnessStates.DOZING:
-        tap(100, 100)
+    if received == size + 4:
+        pixels = buffer[4:]
 
-    elif state == WakefulnessStates.AWAKE:
-        pass
+    elif received == size:
+        pixels = buffer[:size]
 
     else:
-        raise Exception(f'Invalid wakefulness state: {state}')
+        raise Exception(f'Unexpected screencap size. Expected {size} bytes, received {received}.')
 
-    time.sleep(2)
+    screenshot = pixels.reshape(height, width, bytes_per_pixel)
 
-    swipe(100, 100, 500, 500)
+    if conversion is not None:
+        screenshot = cv2.cvtColor(screenshot, conversion)
 
-    if passcode:
-        for digit in passcode:
-            execute_command(f'{ADB_ALIAS} shell input text {digit}')
+    return screenshot
 
-    execute_command(f'{ADB_ALIAS} shell input keyevent 66')
 
-    return get_wakefulness_state()
+def _close_on_loop(loop: asyncio.AbstractEventLoop, *coros):
+    async def close():
+        for coro in coros:
+            await coro
 
+    if loop.is_closed():
+        for coro in coros:
+            coro.close()
 
-def execute_command(
-        command: str,
-        wait: bool = True
-) -> bytes:
+    elif loop is _sync_loop:
+        _run_sync(close())
+
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(close(), loop)
+
+    else:
+        loop.run_until_complete(close())
+
+
+def _get_sync_loop() -> asyncio.AbstractEventLoop:
+    global _sync_loop
+
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever,
+                name='adb-sync-loop',
+                daemon=True
+            ).start()
+
+    return _sync_loop
+
+
+def _run_sync(coro):
+    # Blocking callers may already be inside a running loop (e.g. FastAPI lifespan), so sessions used from sync code
+    # live on a dedicated background loop.
+    return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
+
+
+def _check_shell_result(command: str, result: ShellResult) -> bytes:
+    # Like a command run through the adb binary, it failed if it exited with an error or wrote to stderr.
+    if result.stderr or result.returncode != 0:
+        msg = result.stderr or f'Error executing command. Command: {command}. Return code: {result.returncode}.'
+        raise Exception(msg)
+
+    return result.stdout
+
+
+def _as_shell_command(command: str) -> str | None:
+    prefix = f'{ADB_ALIAS} shell '
+
+    if command.startswith(prefix):
+        return command[len(prefix):]
+
+    return None
+
+
+def execute_command(command: str) -> bytes:
+    shell_command = _as_shell_command(command)
+
+    if shell_command is not None:
+        return _check_shell_result(command, get_default_device().execute(shell_command, check_error=False))
+
+    with metrics.track('execute_command'):
+        return _execute_host_command(command)
+
+
+def _execute_host_command(command: str) -> bytes:
     process = subprocess.Popen(
         command,
         shell=True,
@@ -120,9 +652,7 @@ def execute_command(
         stderr=subprocess.PIPE
     )
 
-    if wait:
-        process.wait()
-
+    # communicate() drains both pipes while waiting. Calling wait() first can deadlock once the output fills the pipe.
     stdout, stderr = process.communicate()
 
     if stderr or process.returncode != 0:
@@ -136,6 +666,67 @@ async def execute_command_async(
         command: str,
         check_error: bool = True
 ):
+    shell_command = _as_shell_command(command)
+
+    if shell_command is not None:
+        result = await get_default_device().execute_async(shell_command, check_error=False)
+        return _check_shell_result(command, result) if check_error else result.stdout
+
+    with metrics.track('execute_command_async'):
+        return await _execute_host_command_async(command, check_error)
+
+
+async def execute_command_stream(command: str, chunk_size: int = 2 ** 16):
+    """
+    Run a host command and yield its stdout in chunks as it is produced, with at most a couple of chunks buffered.
+    Raises with the command's stderr when it exits with an error.
+    """
+    with metrics.track('execute_command_stream'):
+        process = await asyncio.create_subprocess_shell(
+            command,
+            cwd=get_adb_exe_dir(),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=chunk_size,
+            # The shell may leave the command running as its child, so the whole group is killed on an early stop.
+            start_new_session=True
+        )
+
+        # stderr is drained alongside stdout, so a command that writes a lot of it can't block on a full pipe.
+        stderr_task = asyncio.create_task(process.stderr.read())
+
+        try:
+            while chunk := await process.stdout.read(chunk_size):
+                yield chunk
+
+            stderr = await stderr_task
+            await process.wait()
+
+        finally:
+            # Only a consumer that stops reading early leaves the process running.
+            if process.returncode is None:
+                try:
+                    if os.name == 'posix':
+                        os.killpg(process.pid, signal.SIGKILL)
+
+                    else:
+                        process.kill()
+
+                except ProcessLookupError:
+                    pass
+
+                # Reading is paused while the consumer is behind, so the rest of the output is drained to see the pipes
+                # close, which the process has to wait for.
+                await process.stdout.read()
+                await stderr_task
+                await process.wait()
+
+        if process.returncode != 0:
+            msg = stderr or f'Error executing command. Command: {command}. Return code: {process.returncode}.'
+            raise Exception(msg)
+
+
+async def _execute_host_command_async(command: str, check_error: bool):
     process = await asyncio.create_subprocess_shell(
         command,
         cwd=get_adb_exe_dir(),
@@ -143,12 +734,9 @@ async def execute_command_async(
         stderr=asyncio.subprocess.PIPE
     )
 
-    if not check_error:
-        return
-
     stdout, stderr = await process.communicate()
 
-    if stderr or process.returncode != 0:
+    if check_error and (stderr or process.returncode != 0):
         msg = stderr or f'Error executing command. Command: {command}. Return code: {process.returncode}.'
         raise Exception(msg)
 
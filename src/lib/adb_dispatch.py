@@ -0,0 +1,92 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from src.lib.adb_touch import TouchEvent
+
+
+@dataclass
+class InputDispatcher:
+    """
+    An ordered, bounded queue for touch events that callers don't wait on. A failed send is raised from the next
+    `submit` or `join`.
+
+    Every pointer gets its own FIFO queue and worker, so events for a pointer reach the device in the order they were
+    submitted. Events that queue up while the device is busy are sent together as one script. When a queue is full,
+    `submit` waits, which pushes back on producers instead of letting work pile up.
+    """
+    send: Callable[[list[TouchEvent]], Awaitable]
+    max_pending: int = 256
+    max_batch: int = 64
+    max_concurrency: int = 2
+
+    failed: int = field(default=0, init=False)
+    last_error: Exception | None = field(default=None, init=False)
+
+    _error: Exception | None = field(default=None, init=False, repr=False)
+    _queues: dict[int, asyncio.Queue] = field(default_factory=dict, init=False, repr=False)
+    _workers: dict[int, asyncio.Task] = field(default_factory=dict, init=False, repr=False)
+    _semaphore: asyncio.Semaphore = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def submit(self, event: TouchEvent, pointer: int = 0):
+        self._raise_error()
+
+        queue = self._queues.get(pointer)
+
+        if queue is None:
+            queue = self._queues[pointer] = asyncio.Queue(self.max_pending)
+            self._workers[pointer] = asyncio.create_task(self._work(queue))
+
+        await queue.put(event)
+
+    async def join(self):
+        """
+        Wait until every submitted event has been sent. Raises the error of a send that failed since the last call.
+        """
+        for queue in list(self._queues.values()):
+            await queue.join()
+
+        self._raise_error()
+
+    async def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+        self._workers.clear()
+        self._queues.clear()
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                async with self._semaphore:
+                    await self.send(batch)
+
+            except Exception as e:
+                self.failed += len(batch)
+                self.last_error = self._error = e
+
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _raise_error(self):
+        # Nobody waits on the sends, so a failure is raised to the next caller instead, and a dead touch backend can't
+        # go unnoticed.
+        error, self._error = self._error, None
+
+        if error is not None:
+            raise error
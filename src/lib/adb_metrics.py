@@ -0,0 +1,142 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+
+    counts: list[int] = field(init=False)
+    sum: float = field(default=0, init=False)
+    count: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        # The last slot counts observations above the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimate a quantile as the upper bound of the bucket it falls into.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+
+            if cumulative >= rank:
+                return bound
+
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(.5),
+            'p90': self.quantile(.9),
+            'p99': self.quantile(.99),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+        }
+
+
+@dataclass
+class CommandMetrics:
+    latency: Histogram = field(default_factory=Histogram)
+    errors: int = 0
+    in_flight: int = 0
+
+    def snapshot(self) -> dict:
+        return {
+            'latency': self.latency.snapshot(),
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+        }
+
+
+@dataclass
+class MetricsRegistry:
+    """
+    Latency histograms, error counters and in-flight gauges per command kind and device. Commands run both on the
+    caller's event loop and on the adb sync loop thread, so updates are guarded by a lock.
+    """
+    _commands: dict[tuple[str, str], CommandMetrics] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    @contextmanager
+    def track(self, kind: str, device: str | None = None):
+        key = (kind, device or 'default')
+
+        with self._lock:
+            metrics = self._commands.setdefault(key, CommandMetrics())
+            metrics.in_flight += 1
+
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        except Exception:
+            with self._lock:
+                metrics.errors += 1
+
+            raise
+
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                metrics.in_flight -= 1
+                metrics.latency.observe(elapsed)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            snapshot = {}
+
+            for (kind, device), metrics in sorted(self._commands.items()):
+                snapshot.setdefault(device, {})[kind] = metrics.snapshot()
+
+            return snapshot
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            commands = sorted(self._commands.items())
+            duration = ['# TYPE adb_command_duration_seconds histogram']
+            errors = ['# TYPE adb_command_errors_total counter']
+            in_flight = ['# TYPE adb_commands_in_flight gauge']
+
+            for (kind, device), metrics in commands:
+                labels = f'kind="{kind}",device="{device}"'
+                cumulative = 0
+
+                for bound, count in zip([*map(str, metrics.latency.buckets), '+Inf'], metrics.latency.counts):
+                    cumulative += count
+                    duration.append(f'adb_command_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+                duration.append(f'adb_command_duration_seconds_sum{{{labels}}} {metrics.latency.sum}')
+                duration.append(f'adb_command_duration_seconds_count{{{labels}}} {metrics.latency.count}')
+                errors.append(f'adb_command_errors_total{{{labels}}} {metrics.errors}')
+                in_flight.append(f'adb_commands_in_flight{{{labels}}} {metrics.in_flight}')
+
+        return '\n'.join(duration + errors + in_flight) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._commands.clear()
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,168 @@
+import asyncio
+from dataclasses import dataclass
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5037
+
+
+class AdbProtocolError(Exception):
+    pass
+
+
+@dataclass
+class AdbConnection:
+    """
+    A socket to the adb server. Requests are length-prefixed and answered with OKAY or FAIL; once a device service
+    such as `exec:` has been opened, the socket carries that service's raw stream.
+    """
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+
+    @property
+    def is_alive(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    async def send(self, request: str):
+        payload = request.encode()
+        self.writer.write(b'%04x' % len(payload) + payload)
+        await self.writer.drain()
+        await self.read_status()
+
+    async def read_status(self):
+        status = await self.reader.readexactly(4)
+
+        if status == b'OKAY':
+            return
+
+        if status == b'FAIL':
+            raise AdbProtocolError(await self.read_message())
+
+        raise AdbProtocolError(f'Unexpected adb server status: {status!r}')
+
+    async def read_message(self) -> str:
+        length = int(await self.reader.readexactly(4), 16)
+        return (await self.reader.readexactly(length)).decode()
+
+    async def read_all(self) -> bytes:
+        return await self.reader.read()
+
+    async def close(self):
+        if self.writer.is_closing():
+            return
+
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+
+        except ConnectionError:
+            pass
+
+
+@dataclass
+class AdbClient:
+    """
+    An asyncio client for the adb server's smart socket protocol. Every method opens its own connection, which is a
+    local TCP connect rather than a new `adb` process.
+    """
+    serial: str | None = None
+    host: str = DEFAULT_HOST
+    port: int = DEFAULT_PORT
+    limit: int = 2 ** 24
+
+    async def connect(self, limit: int = None) -> AdbConnection:
+        reader, writer = await asyncio.open_connection(
+            self.host,
+            self.port,
+            limit=limit or self.limit
+        )
+
+        return AdbConnection(reader, writer)
+
+    async def request(self, request: str) -> str:
+        """
+        Send a host request that answers with a single message, e.g. `host:version` or `host:devices`.
+        """
+        connection = await self.connect()
+
+        try:
+            await connection.send(request)
+            return await connection.read_message()
+
+        finally:
+            await connection.close()
+
+    async def version(self) -> int:
+        return int(await self.request('host:version'), 16)
+
+    async def devices(self) -> list[tuple[str, str]]:
+        devices = await self.request('host:devices')
+
+        return [
+            tuple(line.split('\t', 1))
+            for line in devices.splitlines()
+            if line.strip()
+        ]
+
+    async def transport(self, limit: int = None) -> AdbConnection:
+        connection = await self.connect(limit)
+
+        try:
+            await connection.send(
+                f'host:transport:{self.serial}' if self.serial else 'host:transport-any'
+            )
+
+        except BaseException:
+            await connection.close()
+            raise
+
+        return connection
+
+    async def open(self, service: str, limit: int = None) -> AdbConnection:
+        """
+        Open a device service, e.g. `exec:screencap` or `shell:ls`, and return the connection carrying its stream.
+        `limit` bounds how much unread output is buffered before reading from the socket is paused.
+        """
+        connection = await self.transport(limit)
+
+        try:
+            await connection.send(service)
+
+        except BaseException:
+            await connection.close()
+            raise
+
+        return connection
+
+    async def exec(self, command: str) -> bytes:
+        """
+        Run a command without a shell and return its raw stdout.
+        """
+        connection = await self.open(f'exec:{command}')
+
+        try:
+            return await connection.read_all()
+
+        finally:
+            await connection.close()
+
+    async def shell(self, command: str) -> bytes:
+        connection = await self.open(f'shell:{command}')
+
+        try:
+            return await connection.read_all()
+
+        finally:
+            await connection.close()
+
+    async def forward(self, local: str, remote: str):
+        prefix = f'host-serial:{self.serial}' if self.serial else 'host'
+        connection = await self.connect()
+
+        try:
+            await connection.send(f'{prefix}:forward:{local};{remote}')
+            # The server answers once for the host request and once more after the forward is set up.
+            await connection.read_status()
+
+        finally:
+            await connection.close()
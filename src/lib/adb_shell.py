@@ -0,0 +1,181 @@
+import asyncio
+import secrets
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from src.lib.adb_protocol import AdbConnection
+
+
+class ShellCommandError(Exception):
+    def __init__(self, command: str, returncode: int, output: bytes, stderr: bytes = b''):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+        self.stderr = stderr
+
+        super().__init__(
+            f'Error executing command. Command: {command}. Return code: {returncode}. Output: {output!r}. '
+            f'Error: {stderr!r}.'
+        )
+
+
+class ShellSessionError(Exception):
+    pass
+
+
+@dataclass
+class ShellResult:
+    stdout: bytes
+    returncode: int
+    stderr: bytes = b''
+
+
+@dataclass
+class ShellSession:
+    """
+    A long-lived shell on the device that receives commands over its stdin stream.
+
+    Each command is followed by a sentinel line carrying its exit code, so the output of consecutive commands can be
+    told apart without opening a new stream. stderr goes to a file in `temp_dir` and is sent after the sentinel, only
+    when there is any. A dead session is reopened on the next command.
+    """
+    opener: Callable[[], Awaitable[AdbConnection]]
+    temp_dir: str = '/data/local/tmp'
+
+    _connection: AdbConnection | None = field(default=None, init=False, repr=False)
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+    _token: str = field(default_factory=lambda: secrets.token_hex(8), init=False, repr=False)
+    _counter: int = field(default=0, init=False, repr=False)
+
+    @property
+    def is_alive(self):
+        return self._connection is not None and self._connection.is_alive
+
+    async def connect(self):
+        if self.is_alive:
+            return
+
+        await self.close()
+        self._connection = await self.opener()
+
+    async def close(self):
+        connection, self._connection = self._connection, None
+
+        if connection is not None:
+            await connection.close()
+
+    async def execute(
+            self,
+            command: str,
+            check_error: bool = True,
+            timeout: float | None = None
+    ) -> ShellResult:
+        async with self._lock:
+            try:
+                result = await asyncio.wait_for(self._execute(command), timeout)
+
+            except (asyncio.TimeoutError, asyncio.CancelledError, ShellSessionError):
+                # The session is somewhere in the middle of a command's output, so it can't be reused.
+                await self.close()
+                raise
+
+        if check_error and result.returncode != 0:
+            raise ShellCommandError(command, result.returncode, result.stdout, result.stderr)
+
+        return result
+
+    async def _execute(self, command: str) -> ShellResult:
+        self._counter += 1
+        marker = f'__ADB_DONE_{self._token}_{self._counter}__'.encode()
+        stderr_path = f'{self.temp_dir}/.adb_shell_{self._token}.stderr'
+
+        # The sentinel carries the exit code and the size of stderr, which follows it. `[ -s ]` is a builtin, so
+        # commands without stderr don't pay for starting `wc` and `cat`.
+        script = (
+            '{\n'
+            f'{command}\n'
+            f'}} </dev/null 2>{stderr_path}\n'
+            '__adb_status=$?\n'
+            f'if [ -s {stderr_path} ]; then\n'
+            f"printf '\\n%s %d %d\\n' {marker.decode()} \"$__adb_status\" \"$(wc -c < {stderr_path})\"\n"
+            f'cat {stderr_path}\n'
+            'else\n'
+            f"printf '\\n%s %d 0\\n' {marker.decode()} \"$__adb_status\"\n"
+            'fi\n'
+        )
+
+        for attempt in range(2):
+            await self.connect()
+
+            try:
+                self._connection.writer.write(script.encode())
+                await self._connection.writer.drain()
+                break
+
+            except (BrokenPipeError, ConnectionResetError):
+                # Nothing was sent, so it is safe to reconnect and try again once.
+                await self.close()
+
+                if attempt:
+                    raise ShellSessionError('Could not write to adb shell session.')
+
+        separator = b'\n' + marker + b' '
+
+        try:
+            stdout = await self._connection.reader.readuntil(separator)
+            returncode, stderr_size = map(int, (await self._connection.reader.readline()).split())
+            stderr = await self._connection.reader.readexactly(stderr_size)
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+            raise ShellSessionError(f'adb shell session ended while executing command: {command}') from e
+
+        return ShellResult(
+            stdout[:-len(separator)],
+            returncode,
+            stderr
+        )
+
+
+@dataclass
+class ShellSessionPool:
+    """
+    A fixed-size pool of shell sessions. Sessions are created lazily and the most recently used idle session is
+    handed out first.
+    """
+    factory: Callable[[], ShellSession]
+    size: int = 2
+
+    _idle: asyncio.LifoQueue = field(default_factory=asyncio.LifoQueue, init=False, repr=False)
+    _sessions: list[ShellSession] = field(default_factory=list, init=False, repr=False)
+
+    async def acquire(self) -> ShellSession:
+        if not self._idle.empty():
+            return self._idle.get_nowait()
+
+        if len(self._sessions) < self.size:
+            session = self.factory()
+            self._sessions.append(session)
+            return session
+
+        return await self._idle.get()
+
+    def release(self, session: ShellSession):
+        self._idle.put_nowait(session)
+
+    async def execute(
+            self,
+            command: str,
+            check_error: bool = True,
+            timeout: float | None = None
+    ) -> ShellResult:
+        session = await self.acquire()
+
+        try:
+            return await session.execute(command, check_error, timeout)
+
+        finally:
+            self.release(session)
+
+    async def close(self):
+        for session in self._sessions:
+            await session.close()
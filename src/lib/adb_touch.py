@@ -0,0 +1,316 @@
+import itertools
+import re
+from dataclasses import dataclass, field
+from typing import Literal
+
+TouchAction = Literal['down', 'up', 'move', 'cancel']
+
+EV_SYN = 0
+EV_KEY = 1
+EV_ABS = 3
+
+SYN_REPORT = 0
+BTN_TOUCH = 330
+
+ABS_MT_SLOT = 47
+ABS_MT_TOUCH_MAJOR = 48
+ABS_MT_POSITION_X = 53
+ABS_MT_POSITION_Y = 54
+ABS_MT_TRACKING_ID = 57
+ABS_MT_PRESSURE = 58
+
+_DEVICE_PATTERN = re.compile(r'^add device \d+: (\S+)', re.MULTILINE)
+_AXIS_PATTERN = re.compile(r'(ABS_MT_\w+)\s*: value -?\d+, min (-?\d+), max (-?\d+)')
+_SIZE_PATTERN = re.compile(r'(Physical|Override) size: (\d+)x(\d+)')
+_ORIENTATION_PATTERN = re.compile(r'SurfaceOrientation: (\d)|orientation=(\d)')
+_GETEVENT_PATTERN = re.compile(r'\[\s*(\d+\.\d+)\]\s+(?:(\S+):\s+)?(\w+)\s+(\w+)\s+(\w+)')
+
+
+@dataclass
+class TouchEvent:
+    action: TouchAction
+    x: int
+    y: int
+
+    # Seconds to wait on the device after this event is injected.
+    delay: float = 0
+
+
+@dataclass
+class Axis:
+    min: int
+    max: int
+
+    def scale(self, value: float) -> int:
+        return round(self.min + value * (self.max - self.min))
+
+    def normalize(self, value: int) -> float:
+        return (value - self.min) / (self.max - self.min)
+
+
+@dataclass
+class TouchScreen:
+    """
+    A touchscreen input device on the phone, described well enough to inject raw multi-touch (type B) events.
+    """
+    path: str
+    x: Axis
+    y: Axis
+    width: int
+    height: int
+    rotation: int = 0
+    has_slot: bool = True
+    has_pressure: bool = False
+    has_touch_major: bool = False
+    has_btn_touch: bool = True
+
+    _tracking_ids: itertools.count = field(default_factory=itertools.count, init=False, repr=False)
+
+    @property
+    def display_size(self) -> tuple[int, int]:
+        if self.rotation % 2:
+            return self.height, self.width
+
+        return self.width, self.height
+
+    def to_raw(self, x: int, y: int) -> tuple[int, int]:
+        """
+        Map display coordinates in the current rotation to raw axis values in the panel's natural orientation.
+        """
+        width, height = self.display_size
+        dx, dy = x / width, y / height
+
+        if self.rotation == 1:
+            nx, ny = 1 - dy, dx
+
+        elif self.rotation == 2:
+            nx, ny = 1 - dx, 1 - dy
+
+        elif self.rotation == 3:
+            nx, ny = dy, 1 - dx
+
+        else:
+            nx, ny = dx, dy
+
+        return self.x.scale(nx), self.y.scale(ny)
+
+    def from_raw(self, raw_x: int, raw_y: int) -> tuple[float, float]:
+        """
+        Map raw axis values to display coordinates in the current rotation, normalized to [0, 1].
+        """
+        nx, ny = self.x.normalize(raw_x), self.y.normalize(raw_y)
+
+        if self.rotation == 1:
+            return ny, 1 - nx
+
+        if self.rotation == 2:
+            return 1 - nx, 1 - ny
+
+        if self.rotation == 3:
+            return 1 - ny, nx
+
+        return nx, ny
+
+    def compile(self, events: list[TouchEvent]) -> str:
+        """
+        Compile touch events into a shell script of `sendevent` writes.
+        """
+        lines = []
+
+        for event in events:
+            writes = []
+
+            if event.action == 'down':
+                tracking_id = next(self._tracking_ids) % 65535
+                raw_x, raw_y = self.to_raw(event.x, event.y)
+
+                if self.has_slot:
+                    writes.append((EV_ABS, ABS_MT_SLOT, 0))
+
+                writes.append((EV_ABS, ABS_MT_TRACKING_ID, tracking_id))
+                writes.append((EV_ABS, ABS_MT_POSITION_X, raw_x))
+                writes.append((EV_ABS, ABS_MT_POSITION_Y, raw_y))
+
+                if self.has_touch_major:
+                    writes.append((EV_ABS, ABS_MT_TOUCH_MAJOR, 5))
+
+                if self.has_pressure:
+                    writes.append((EV_ABS, ABS_MT_PRESSURE, 50))
+
+                if self.has_btn_touch:
+                    writes.append((EV_KEY, BTN_TOUCH, 1))
+
+            elif event.action == 'move':
+                raw_x, raw_y = self.to_raw(event.x, event.y)
+
+                writes.append((EV_ABS, ABS_MT_POSITION_X, raw_x))
+                writes.append((EV_ABS, ABS_MT_POSITION_Y, raw_y))
+
+            elif event.action in ('up', 'cancel'):
+                writes.append((EV_ABS, ABS_MT_TRACKING_ID, -1))
+
+                if self.has_btn_touch:
+                    writes.append((EV_KEY, BTN_TOUCH, 0))
+
+            else:
+                raise ValueError(f'Invalid touch action: {event.action}')
+
+            writes.append((EV_SYN, SYN_REPORT, 0))
+
+            lines.extend(
+                f'sendevent {self.path} {type_} {code} {value}'
+                for type_, code, value in writes
+            )
+
+            if event.delay > 0:
+                lines.append(f'sleep {event.delay:.3f}')
+
+        return '\n'.join(lines)
+
+
+def compile_motionevents(events: list[TouchEvent]) -> str:
+    """
+    Compile touch events into a shell script of `input motionevent` calls.
+    """
+    lines = []
+
+    for event in events:
+        lines.append(f'input motionevent {event.action.upper()} {event.x} {event.y}')
+
+        if event.delay > 0:
+            lines.append(f'sleep {event.delay:.3f}')
+
+    return '\n'.join(lines)
+
+
+def parse_touchscreen(getevent_output: str, wm_size_output: str, dumpsys_input_output: str = '') -> TouchScreen:
+    """
+    Build a TouchScreen from the output of `getevent -pl`, `wm size` and optionally `dumpsys input`.
+    """
+    devices = _DEVICE_PATTERN.split(getevent_output)[1:]
+    candidates = []
+
+    for path, description in zip(devices[::2], devices[1::2]):
+        axes = {
+            name: Axis(int(min_), int(max_))
+            for name, min_, max_ in _AXIS_PATTERN.findall(description)
+        }
+
+        if 'ABS_MT_POSITION_X' not in axes or 'ABS_MT_POSITION_Y' not in axes:
+            continue
+
+        candidates.append((
+            'INPUT_PROP_DIRECT' in description,
+            path,
+            axes,
+            description
+        ))
+
+    if not candidates:
+        raise Exception('Could not find a multi-touch input device.')
+
+    # Prefer direct input devices (touchscreens) over touchpads.
+    candidates.sort(key=lambda candidate: not candidate[0])
+    _, path, axes, description = candidates[0]
+
+    sizes = {kind: (int(w), int(h)) for kind, w, h in _SIZE_PATTERN.findall(wm_size_output)}
+    size = sizes.get('Override') or sizes.get('Physical')
+
+    if size is None:
+        raise Exception(f'Could not parse display size: {wm_size_output}')
+
+    orientation = _ORIENTATION_PATTERN.search(dumpsys_input_output)
+    rotation = int(next(group for group in orientation.groups() if group)) if orientation else 0
+
+    return TouchScreen(
+        path=path,
+        x=axes['ABS_MT_POSITION_X'],
+        y=axes['ABS_MT_POSITION_Y'],
+        width=size[0],
+        height=size[1],
+        rotation=rotation,
+        has_slot='ABS_MT_SLOT' in axes,
+        has_pressure='ABS_MT_PRESSURE' in axes,
+        has_touch_major='ABS_MT_TOUCH_MAJOR' in axes,
+        has_btn_touch='BTN_TOUCH' in description
+    )
+
+
+@dataclass
+class GeteventParser:
+    """
+    Incrementally turns `getevent -lt` lines from a touchscreen into the mouse event schema used by recordings, i.e.
+    dicts with normalized `x` and `y`, a `type` of mousedown/mousemove/mouseup and a `timestamp` in milliseconds taken
+    from the kernel clock. Only the first pointer (slot 0) is followed.
+    """
+    touchscreen: TouchScreen
+
+    _slot: int = field(default=0, init=False, repr=False)
+    _raw_x: int | None = field(default=None, init=False, repr=False)
+    _raw_y: int | None = field(default=None, init=False, repr=False)
+    _touching: bool = field(default=False, init=False, repr=False)
+    _pending: str | None = field(default=None, init=False, repr=False)
+    _moved: bool = field(default=False, init=False, repr=False)
+
+    def feed(self, line: str) -> list[dict]:
+        match = _GETEVENT_PATTERN.match(line.strip())
+
+        if not match:
+            return []
+
+        timestamp, _, type_, code, value = match.groups()
+
+        if type_ == 'EV_SYN' and code == 'SYN_REPORT':
+            return self._report(float(timestamp))
+
+        if type_ == 'EV_ABS' and code == 'ABS_MT_SLOT':
+            self._slot = int(value, 16)
+
+        elif self._slot != 0:
+            return []
+
+        elif type_ == 'EV_ABS' and code == 'ABS_MT_TRACKING_ID':
+            self._pending = 'mouseup' if value == 'ffffffff' else 'mousedown'
+
+        elif type_ == 'EV_KEY' and code == 'BTN_TOUCH':
+            self._pending = self._pending or ('mousedown' if value == 'DOWN' else 'mouseup')
+
+        elif type_ == 'EV_ABS' and code == 'ABS_MT_POSITION_X':
+            self._raw_x = int(value, 16)
+            self._moved = True
+
+        elif type_ == 'EV_ABS' and code == 'ABS_MT_POSITION_Y':
+            self._raw_y = int(value, 16)
+            self._moved = True
+
+        return []
+
+    def _report(self, timestamp: float) -> list[dict]:
+        pending, moved = self._pending, self._moved
+        self._pending, self._moved = None, False
+
+        if self._raw_x is None or self._raw_y is None:
+            return []
+
+        if pending == 'mousedown' and not self._touching:
+            self._touching = True
+            type_ = 'mousedown'
+
+        elif pending == 'mouseup' and self._touching:
+            self._touching = False
+            type_ = 'mouseup'
+
+        elif moved and self._touching:
+            type_ = 'mousemove'
+
+        else:
+            return []
+
+        x, y = self.touchscreen.from_raw(self._raw_x, self._raw_y)
+
+        return [{
+            'x': x,
+            'y': y,
+            'type': type_,
+            'timestamp': round(timestamp * 1000),
+        }]
@@ -1,75 +1,527 @@
 import asyncio
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Awaitable, Callable, Literal, TypeVar
 
 import aiohttp
 import cv2
 import numpy as np
-import requests
 
-from src.lib import adb
-from src.lib.adb import screencap, execute_command, execute_command_async
+from src import paths
+from src.lib import adb, vision
+from src.lib.adb import AdbDevice
+from src.lib.adb_touch import TouchEvent
+from src.lib.android_capture import CapturedFrame, CaptureService, DecodeMode, FrameBroadcaster, Region, decode
+from src.lib.android_screenrecord import ScreenRecordSource
+from src.lib.commons import PerLoop
+from src.lib.vision import Detector, Frame, ScaleCalibration
 
+_T = TypeVar('_T')
 
-def take_screenshot_with_adb(save_path: str = None) -> np.ndarray:
-    path = screencap()
+SCREENSHOT_SERVER_PORT = 8080
 
-    screenshot = cv2.imread(
-        str(path),
-        cv2.IMREAD_UNCHANGED
-    )
+_default_device: 'AndroidDevice | None' = None
+
+
+@dataclass
+class ScreenshotClient:
+    """
+    Fetches screenshots from the on-device screenshot server over pooled keep-alive connections. Decoding runs on a
+    worker thread so the event loop keeps serving input and websockets while a frame is being decoded.
+    """
+    url: str
+    timeout: float = 5
+    max_connections: int = 4
+
+    # aiohttp sessions belong to the loop they were created on, so every event loop gets its own.
+    _sessions: PerLoop[aiohttp.ClientSession] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._sessions = PerLoop(self._create_session, is_stale=lambda session: session.closed)
+
+    async def fetch(self) -> bytes:
+        async with self._get_session().get(self.url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def take_screenshot(self, mode: DecodeMode = 'color') -> np.ndarray:
+        return await asyncio.to_thread(decode_screenshot, await self.fetch(), mode)
 
-    Path(path).unlink()
+    async def take_screenshots(self, mode: DecodeMode = 'color'):
+        while True:
+            yield await self.take_screenshot(mode)
+
+    async def close(self):
+        session = self._sessions.pop()
+
+        if session is not None:
+            await session.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        return self._sessions.get()
 
-    if save_path:
-        cv2.imwrite(
-            save_path,
-            screenshot
+    def _create_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=30
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
         )
 
-    return screenshot
 
+@dataclass
+class AndroidDevice:
+    """
+    A device as seen by the bots: input over adb plus the screenshot server, reached through its own forwarded port.
+    """
+    adb: AdbDevice = field(default_factory=adb.get_default_device)
+    screenshot_port: int = SCREENSHOT_SERVER_PORT
 
-async def take_screenshot_with_api() -> np.ndarray:
-    response = requests.get('http://127.0.0.1:8080')
-    response.raise_for_status()
+    screenshot_client: ScreenshotClient = field(init=False)
+    scale_calibration: ScaleCalibration = field(init=False)
 
-    screenshot = cv2.imdecode(
-        np.frombuffer(
-            response.content,
-            np.uint8
-        ),
-        cv2.IMREAD_UNCHANGED
-    )
+    # The services' tasks and conditions belong to the loop they were created on.
+    _capture_services: PerLoop[CaptureService] = field(init=False, repr=False)
+    _broadcasters: PerLoop[FrameBroadcaster] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.screenshot_client = ScreenshotClient(self.screenshot_url)
+        self.scale_calibration = ScaleCalibration(paths.get_calibration(self.adb.serial))
+        self._capture_services = PerLoop(lambda: CaptureService(self.screenshot_client.fetch))
+        self._broadcasters = PerLoop(lambda: FrameBroadcaster(self.iter_frames))
+
+    @property
+    def last_input_at(self) -> float:
+        """
+        When the most recent touch events were sent to the device, so frames can be required to show their effect.
+        """
+        return self.adb.last_input_at
+
+    @property
+    def screenshot_url(self):
+        return f'http://127.0.0.1:{self.screenshot_port}'
+
+    def forward_screenshot_port(self):
+        self.adb.forward_port(self.screenshot_port, SCREENSHOT_SERVER_PORT)
+
+    def take_screenshot_with_adb(self, save_path: str = None, mode: Literal['raw', 'png'] = 'raw') -> np.ndarray:
+        if mode == 'raw':
+            screenshot = self.adb.screencap_raw()
+
+        else:
+            path = self.adb.screencap()
+
+            screenshot = cv2.imread(
+                str(path),
+                cv2.IMREAD_UNCHANGED
+            )
+
+            Path(path).unlink()
+
+        if save_path:
+            cv2.imwrite(
+                save_path,
+                screenshot
+            )
+
+        return screenshot
+
+    async def take_screenshot_with_api(self, mode: DecodeMode = 'color') -> np.ndarray:
+        return await self.screenshot_client.take_screenshot(mode)
+
+    async def take_screenshots_with_api(self, mode: DecodeMode = 'color'):
+        async for screenshot in self.screenshot_client.take_screenshots(mode):
+            yield screenshot
+
+    async def stream_frames(self, bit_rate: int = 8_000_000, size: tuple[int, int] = None):
+        """
+        Yield timestamped frames decoded from a live `screenrecord` stream.
+        """
+        async for frame in ScreenRecordSource(self.adb, bit_rate, size).frames():
+            yield frame
+
+    async def take_screenshots_with_screenrecord(
+            self,
+            mode: DecodeMode = 'color',
+            bit_rate: int = 8_000_000,
+            size: tuple[int, int] = None
+    ):
+        async for frame in self.stream_frames(bit_rate, size):
+            yield await frame.decode_async(mode)
+
+    async def get_frame(
+            self,
+            max_age_ms: float | None = 500,
+            newer_than: float | None = None,
+            timeout: float | None = 5
+    ) -> CapturedFrame:
+        """
+        Return a recent frame from the shared background capture instead of taking a new screenshot. By default the
+        frame is at most 500ms old and newer than the last input sent to the device.
+        """
+        return await self.get_capture_service().get_frame(
+            max_age_ms=max_age_ms,
+            newer_than=self.last_input_at if newer_than is None else newer_than,
+            timeout=timeout
+        )
 
-    return screenshot
+    async def get_image(
+            self,
+            mode: DecodeMode = 'color',
+            max_age_ms: float | None = 500,
+            newer_than: float | None = None,
+            timeout: float | None = 5
+    ) -> np.ndarray:
+        frame = await self.get_frame(max_age_ms, newer_than, timeout)
+        return await frame.decode_async(mode)
 
+    async def iter_frames(self):
+        """
+        Yield every new frame from the shared background capture.
+        """
+        frame = await self.get_frame(newer_than=0)
 
-async def take_screenshots_with_api():
-    async with aiohttp.ClientSession() as session:
         while True:
-            async with session.get('http://127.0.0.1:8080') as response:
-                response.raise_for_status()
-                content = await response.read()
+            yield frame
+            frame = await self.get_frame(max_age_ms=None, newer_than=frame.timestamp)
+
+    async def subscribe_frames(self):
+        """
+        Subscribe to the device's frame broadcast. Every subscriber on the loop shares one capture, and a subscriber
+        that falls behind skips frames rather than slowing the others down.
+        """
+        async for frame in self.get_broadcaster().subscribe():
+            yield frame
+
+    async def wait_for_change(
+            self,
+            region: Region = None,
+            since: CapturedFrame = None,
+            threshold: float = 2,
+            timeout: float | None = 5
+    ) -> CapturedFrame:
+        """
+        Wait for the first frame whose `region` (x, y, w, h) differs from the one in `since`, which defaults to the
+        current frame, and return it.
+        """
+        async def wait():
+            baseline = since or await self.get_frame(newer_than=0)
+            frame = baseline
+
+            while True:
+                frame = await self.get_frame(max_age_ms=None, newer_than=frame.timestamp)
+
+                if await frame.get_difference(baseline, region) > threshold:
+                    return frame
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def wait_for_stable_frame(
+            self,
+            region: Region = None,
+            quiet_ms: float = 200,
+            threshold: float = 2,
+            timeout: float | None = 5
+    ) -> CapturedFrame:
+        """
+        Wait until the `region` (x, y, w, h) has not changed for `quiet_ms` since the last input and return the settled
+        frame. Use this instead of sleeping for the worst case after an action, with a region that leaves out anything
+        that keeps moving, like the animated background. Raises TimeoutError if the region doesn't settle in time.
+        """
+        async def wait():
+            # Frames are compared with the first one of the quiet period, so slow drift adds up instead of hiding in
+            # small differences between consecutive frames.
+            reference = await self.get_frame()
+            frame = reference
+
+            while True:
+                frame = await self.get_frame(max_age_ms=None, newer_than=frame.timestamp)
+
+                if await frame.get_difference(reference, region) > threshold:
+                    reference = frame
+
+                elif frame.timestamp - reference.timestamp >= quiet_ms / 1000:
+                    return frame
+
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+
+        except TimeoutError:
+            raise TimeoutError(f'Region {region} did not settle within {timeout}s.')
+
+    async def wait_until(
+            self,
+            detector: Detector,
+            timeout: float | None = 5,
+            mode: DecodeMode = 'gray',
+            newer_than: float | None = None
+    ):
+        """
+        Run `detector` on every new frame, starting with the first one newer than the last input, and return its result
+        for the first frame it hits on. Detectors get a vision Frame, so combined detectors share its preprocessing, and
+        run on a worker thread with templates matched at the scales calibrated for this device.
+        """
+        async def wait():
+            frame = await self.get_frame(newer_than=newer_than)
+
+            while True:
+                result = await asyncio.to_thread(self.detect, detector, await frame.to_frame(mode))
+
+                if result is not None:
+                    return result
+
+                frame = await self.get_frame(max_age_ms=None, newer_than=frame.timestamp)
+
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+
+        except TimeoutError:
+            raise TimeoutError(f'Detector {getattr(detector, "__qualname__", detector)} did not hit within {timeout}s.')
+
+    def detect(self, detector: Detector, image: np.ndarray | Frame):
+        """
+        Run a detector, or any template matcher, with templates matched at the scales calibrated for this device.
+        """
+        with vision.use_calibration(self.scale_calibration):
+            return detector(image)
+
+    def get_broadcaster(self) -> FrameBroadcaster:
+        return self._broadcasters.get()
+
+    def get_capture_service(self) -> CaptureService:
+        return self._capture_services.get()
+
+    async def gesture(
+            self,
+            points: list[tuple[int, int]],
+            timings: list[float] | float = 0,
+            do_async: bool = True
+    ):
+        """
+        Perform a single-pointer gesture in one device round-trip. The pointer goes down at the first point, moves
+        through the points in between and is released at the last point. `timings` are the delays in seconds after
+        each point, either one per point or a single value for all of them, and are enforced on the device. Nothing
+        waits after the release, so the last point's delay only counts for a single-point gesture, as its hold.
+        """
+        await self._inject(_stroke(points, timings), do_async)
+
+    async def tap(self, x: int, y: int, hold: float = .02):
+        await self.gesture([(x, y), (x, y)], [hold, 0])
+
+    async def long_press(self, x: int, y: int, duration: float = 1):
+        await self.gesture([(x, y), (x, y)], [duration, 0])
+
+    async def drag(self, start: tuple[int, int], end: tuple[int, int], steps: int = 25, duration: float = .25):
+        points = [
+            (
+                round(start[0] + (end[0] - start[0]) * i / steps),
+                round(start[1] + (end[1] - start[1]) * i / steps)
+            )
+            for i in range(steps + 1)
+        ]
+
+        await self.gesture(points, duration / steps)
+
+    async def multi_tap(self, x: int, y: int, times: int, interval: float = .1, hold: float = .02):
+        events = []
+
+        for i in range(times):
+            events.extend([
+                TouchEvent('down', x, y, hold),
+                TouchEvent('up', x, y, interval if i < times - 1 else 0)
+            ])
 
-                yield cv2.imdecode(
-                    np.frombuffer(content, np.uint8),
-                    cv2.IMREAD_UNCHANGED
-                )
+        await self._inject(events)
 
+    async def press(self, x: int, y: int, do_async: bool = True):
+        await self._inject([TouchEvent('down', x, y)], do_async)
 
-async def tap(x: int, y: int):
-    await press(x, y)
-    await asyncio.sleep(.02)
-    await release(x, y)
+    async def release(self, x: int, y: int, do_async: bool = True):
+        await self._inject([TouchEvent('up', x, y)], do_async)
+
+    async def move(self, x: int, y: int, do_async: bool = True):
+        await self._inject([TouchEvent('move', x, y)], do_async)
+
+    async def _inject(self, events: list[TouchEvent], do_async: bool = True):
+        await self.adb.motionevents(events, do_async=do_async)
+
+
+def decode_screenshot(content: bytes, mode: DecodeMode = 'color') -> np.ndarray:
+    return decode(content, mode)
+
+
+def get_default_device() -> AndroidDevice:
+    global _default_device
+
+    if _default_device is None:
+        _default_device = AndroidDevice()
+
+    return _default_device
+
+
+def get_devices(base_screenshot_port: int = SCREENSHOT_SERVER_PORT) -> list[AndroidDevice]:
+    """
+    Create a device for every phone attached to the adb server, each with its screenshot server forwarded to its own
+    local port starting at `base_screenshot_port`.
+    """
+    devices = [
+        AndroidDevice(adb_device, base_screenshot_port + i)
+        for i, adb_device in enumerate(adb.list_devices())
+    ]
+
+    for device in devices:
+        device.forward_screenshot_port()
+
+    return devices
+
+
+async def run_on_devices(
+        devices: list[AndroidDevice],
+        fn: Callable[[AndroidDevice], Awaitable[_T]]
+) -> list[_T | BaseException]:
+    """
+    Run `fn` for every device concurrently on the current event loop. A failure on one device does not stop the others;
+    its exception is returned in place of a result.
+    """
+    return await asyncio.gather(
+        *(fn(device) for device in devices),
+        return_exceptions=True
+    )
+
+
+def take_screenshot_with_adb(save_path: str = None, mode: Literal['raw', 'png'] = 'raw') -> np.ndarray:
+    return get_default_device().take_screenshot_with_adb(save_path, mode)
+
+
+async def take_screenshot_with_api(mode: DecodeMode = 'color') -> np.ndarray:
+    return await get_default_device().take_screenshot_with_api(mode)
+
+
+async def take_screenshots_with_api(mode: DecodeMode = 'color'):
+    async for screenshot in get_default_device().take_screenshots_with_api(mode):
+        yield screenshot
+
+
+async def stream_frames(bit_rate: int = 8_000_000, size: tuple[int, int] = None):
+    async for frame in get_default_device().stream_frames(bit_rate, size):
+        yield frame
+
+
+async def take_screenshots_with_screenrecord(
+        mode: DecodeMode = 'color',
+        bit_rate: int = 8_000_000,
+        size: tuple[int, int] = None
+):
+    async for screenshot in get_default_device().take_screenshots_with_screenrecord(mode, bit_rate, size):
+        yield screenshot
+
+
+async def get_frame(
+        max_age_ms: float | None = 500,
+        newer_than: float | None = None,
+        timeout: float | None = 5
+) -> CapturedFrame:
+    return await get_default_device().get_frame(max_age_ms, newer_than, timeout)
+
+
+async def get_image(
+        mode: DecodeMode = 'color',
+        max_age_ms: float | None = 500,
+        newer_than: float | None = None,
+        timeout: float | None = 5
+) -> np.ndarray:
+    return await get_default_device().get_image(mode, max_age_ms, newer_than, timeout)
+
+
+async def subscribe_frames():
+    async for frame in get_default_device().subscribe_frames():
+        yield frame
+
+
+async def wait_for_change(
+        region: Region = None,
+        since: CapturedFrame = None,
+        threshold: float = 2,
+        timeout: float | None = 5
+) -> CapturedFrame:
+    return await get_default_device().wait_for_change(region, since, threshold, timeout)
+
+
+async def wait_for_stable_frame(
+        region: Region = None,
+        quiet_ms: float = 200,
+        threshold: float = 2,
+        timeout: float | None = 5
+) -> CapturedFrame:
+    return await get_default_device().wait_for_stable_frame(region, quiet_ms, threshold, timeout)
+
+
+async def wait_until(
+        detector: Detector,
+        timeout: float | None = 5,
+        mode: DecodeMode = 'gray',
+        newer_than: float | None = None
+):
+    return await get_default_device().wait_until(detector, timeout, mode, newer_than)
+
+
+async def gesture(
+        points: list[tuple[int, int]],
+        timings: list[float] | float = 0,
+        do_async: bool = True
+):
+    await get_default_device().gesture(points, timings, do_async)
+
+
+async def tap(x: int, y: int, hold: float = .02):
+    await get_default_device().tap(x, y, hold)
+
+
+async def long_press(x: int, y: int, duration: float = 1):
+    await get_default_device().long_press(x, y, duration)
+
+
+async def drag(start: tuple[int, int], end: tuple[int, int], steps: int = 25, duration: float = .25):
+    await get_default_device().drag(start, end, steps, duration)
+
+
+async def multi_tap(x: int, y: int, times: int, interval: float = .1, hold: float = .02):
+    await get_default_device().multi_tap(x, y, times, interval, hold)
 
 
 async def press(x: int, y: int, do_async: bool = True):
-    await adb.motionevent('down', x, y, do_async=do_async)
+    await get_default_device().press(x, y, do_async)
 
 
 async def release(x: int, y: int, do_async: bool = True):
-    await adb.motionevent('up', x, y, do_async=do_async)
+    await get_default_device().release(x, y, do_async)
 
 
 async def move(x: int, y: int, do_async: bool = True):
-    await adb.motionevent('move', x, y, do_async=do_async)
+    await get_default_device().move(x, y, do_async)
+
+
+def _stroke(points: list[tuple[int, int]], timings: list[float] | float = 0) -> list[TouchEvent]:
+    if not points:
+        raise ValueError('A gesture needs at least one point.')
+
+    if not isinstance(timings, list):
+        timings = [timings] * len(points)
+
+    if len(timings) != len(points):
+        raise ValueError(f'Expected {len(points)} timings, got {len(timings)}.')
+
+    # A single point is a press and release in place, held for the point's delay like tap().
+    if len(points) == 1:
+        points = [points[0], points[0]]
+
+    # Delays only go between events; the gesture is over once the pointer is released.
+    timings = timings[:len(points) - 1] + [0]
+
+    actions = ['down'] + ['move'] * (len(points) - 2) + ['up']
+
+    return [
+        TouchEvent(action, x, y, delay)
+        for action, (x, y), delay in zip(actions, points, timings)
+    ]
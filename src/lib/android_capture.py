@@ -0,0 +1,340 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Literal
+
+import cv2
+import numpy as np
+
+from src.lib.vision import Frame
+
+Region = tuple[int, int, int, int]
+
+DecodeMode = Literal['color', 'color_2', 'color_4', 'gray', 'gray_2', 'gray_4']
+
+# The reduced modes are decoded at half or a quarter of the resolution, which libjpeg does much faster than a full
+# decode followed by a resize. Coordinates found in them have to be scaled back up by the reduction factor.
+DECODE_FLAGS: dict[DecodeMode, int] = {
+    'color': cv2.IMREAD_UNCHANGED,
+    'color_2': cv2.IMREAD_REDUCED_COLOR_2,
+    'color_4': cv2.IMREAD_REDUCED_COLOR_4,
+    'gray': cv2.IMREAD_GRAYSCALE,
+    'gray_2': cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    'gray_4': cv2.IMREAD_REDUCED_GRAYSCALE_4,
+}
+
+
+# Frames are compared on a quarter resolution decode shrunk further to a small thumbnail, which is cheap enough to do
+# for every captured frame and still shows UI transitions and animations.
+SIGNATURE_MODE: DecodeMode = 'gray_4'
+SIGNATURE_SCALE = 1 / 4
+SIGNATURE_SIZE = (32, 32)
+
+
+def decode(content: bytes, mode: DecodeMode = 'color') -> np.ndarray:
+    return cv2.imdecode(
+        np.frombuffer(content, np.uint8),
+        DECODE_FLAGS[mode]
+    )
+
+
+def convert(image: np.ndarray, mode: DecodeMode = 'color') -> np.ndarray:
+    """
+    Produce a decode mode from an already decoded colour image, for frames that don't arrive as an encoded image.
+    """
+    color, _, factor = mode.partition('_')
+
+    if color == 'gray' and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+
+    if factor:
+        image = cv2.resize(image, None, fx=1 / int(factor), fy=1 / int(factor), interpolation=cv2.INTER_AREA)
+
+    return image
+
+
+def get_signature(image: np.ndarray, region: Region = None, scale: float = 1) -> np.ndarray:
+    """
+    Shrink an image, or the `region` (x, y, w, h) of it, to a small grayscale thumbnail for comparing frames. `scale`
+    maps region coordinates onto the image, e.g. 1 / 4 for a reduced decode.
+    """
+    if region is not None:
+        x, y, w, h = (round(value * scale) for value in region)
+        image = image[y:y + max(h, 1), x:x + max(w, 1)]
+
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    return cv2.resize(image, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def get_difference(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    The mean absolute difference between two signatures, from 0 for identical frames to 255.
+    """
+    return float(cv2.absdiff(a, b).mean())
+
+
+@dataclass
+class CapturedFrame:
+    """
+    An encoded screenshot that is decoded lazily, at most once per decode mode. Frames from a video stream arrive
+    decoded and have no `data`; their other modes are converted from the colour image instead.
+    """
+    data: bytes | None
+
+    # time.monotonic() when the capture was requested; the screen is at least this new.
+    timestamp: float
+    index: int
+
+    _decoded: dict[DecodeMode, np.ndarray] = field(default_factory=dict, init=False, repr=False)
+    _decoding: dict[DecodeMode, asyncio.Task] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _signatures: dict[Region | None, np.ndarray] = field(default_factory=dict, init=False, repr=False)
+    _frames: dict[DecodeMode, Frame] = field(default_factory=dict, init=False, repr=False)
+
+    @classmethod
+    def from_image(cls, image: np.ndarray, timestamp: float, index: int) -> 'CapturedFrame':
+        frame = cls(None, timestamp, index)
+        frame._decoded['color'] = image
+        return frame
+
+    @property
+    def image(self) -> np.ndarray:
+        return self.decode('color')
+
+    @property
+    def gray(self) -> np.ndarray:
+        return self.decode('gray')
+
+    def decode(self, mode: DecodeMode = 'color') -> np.ndarray:
+        image = self._decoded.get(mode)
+
+        if image is not None:
+            return image
+
+        # Frames are shared between consumers on worker threads; the lock makes sure each mode is decoded only once.
+        with self._lock:
+            image = self._decoded.get(mode)
+
+            if image is None:
+                if self.data is None:
+                    image = convert(self._decoded['color'], mode)
+
+                else:
+                    image = decode(self.data, mode)
+
+                self._decoded[mode] = image
+
+            return image
+
+    async def decode_async(self, mode: DecodeMode = 'color') -> np.ndarray:
+        if mode in self._decoded:
+            return self._decoded[mode]
+
+        # Concurrent consumers wait on the same decode instead of each starting one. It is shielded, so a consumer that
+        # gives up doesn't cancel it for the others.
+        task = self._decoding.get(mode)
+
+        if task is None:
+            task = self._decoding[mode] = asyncio.create_task(asyncio.to_thread(self.decode, mode))
+            task.add_done_callback(lambda _: self._decoding.pop(mode, None))
+
+        return await asyncio.shield(task)
+
+    async def to_frame(self, mode: DecodeMode = 'gray') -> Frame:
+        """
+        The decoded image as a vision Frame, shared by every detector that looks at this capture.
+        """
+        frame = self._frames.get(mode)
+
+        if frame is None:
+            image = await self.decode_async(mode)
+            frame = self._frames.setdefault(mode, Frame(image))
+
+        return frame
+
+    async def get_signature(self, region: Region = None) -> np.ndarray:
+        if region is not None:
+            region = tuple(region)
+
+        signature = self._signatures.get(region)
+
+        if signature is None:
+            image = await self.decode_async(SIGNATURE_MODE)
+            signature = self._signatures.setdefault(region, get_signature(image, region, SIGNATURE_SCALE))
+
+        return signature
+
+    async def get_difference(self, other: 'CapturedFrame', region: Region = None) -> float:
+        return get_difference(
+            await self.get_signature(region),
+            await other.get_signature(region)
+        )
+
+
+@dataclass
+class CaptureService:
+    """
+    Captures frames in the background and keeps the newest one, so consumers can share a recent frame instead of each
+    issuing their own capture. Capturing starts on the first request and stops again after `idle_timeout` seconds
+    without one.
+    """
+    capture: Callable[[], Awaitable[bytes]]
+    interval: float = 0
+    idle_timeout: float = 2
+    retry_delay: float = .5
+
+    _latest: CapturedFrame | None = field(default=None, init=False, repr=False)
+    _error: Exception | None = field(default=None, init=False, repr=False)
+    _condition: asyncio.Condition = field(default_factory=asyncio.Condition, init=False, repr=False)
+    _task: asyncio.Task | None = field(default=None, init=False, repr=False)
+    _last_request: float = field(default=0, init=False, repr=False)
+    _count: int = field(default=0, init=False, repr=False)
+
+    @property
+    def latest(self) -> CapturedFrame | None:
+        return self._latest
+
+    async def get_frame(
+            self,
+            max_age_ms: float | None = None,
+            newer_than: float | None = None,
+            timeout: float | None = 5
+    ) -> CapturedFrame:
+        """
+        Return the newest frame if it is at most `max_age_ms` old and was captured after the `newer_than` timestamp
+        (time.monotonic()), otherwise wait for the next frame that is.
+        """
+        self._last_request = time.monotonic()
+        self._ensure_running()
+
+        def is_ready():
+            return self._error is not None or self._is_fresh(max_age_ms, newer_than)
+
+        async with self._condition:
+            await asyncio.wait_for(self._condition.wait_for(is_ready), timeout)
+
+            if self._is_fresh(max_age_ms, newer_than):
+                return self._latest
+
+            raise self._error
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _is_fresh(self, max_age_ms: float | None, newer_than: float | None) -> bool:
+        frame = self._latest
+
+        if frame is None:
+            return False
+
+        if max_age_ms is not None and time.monotonic() - frame.timestamp > max_age_ms / 1000:
+            return False
+
+        if newer_than is not None and frame.timestamp <= newer_than:
+            return False
+
+        return True
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while time.monotonic() - self._last_request < self.idle_timeout:
+            timestamp = time.monotonic()
+
+            try:
+                data = await self.capture()
+
+            except Exception as e:
+                await self._publish(error=e)
+                await asyncio.sleep(self.retry_delay)
+                continue
+
+            self._count += 1
+            await self._publish(CapturedFrame(data, timestamp, self._count))
+
+            if self.interval:
+                await asyncio.sleep(self.interval)
+
+    async def _publish(self, frame: CapturedFrame = None, error: Exception = None):
+        async with self._condition:
+            if frame is not None:
+                self._latest = frame
+
+            self._error = error
+            self._condition.notify_all()
+
+
+@dataclass
+class FrameBroadcaster:
+    """
+    Runs one frame source and fans its frames out to every subscriber. Each subscriber has its own small queue that
+    drops its oldest frame when full, so a slow subscriber skips frames instead of holding up the source or the others.
+    The source runs while there is at least one subscriber.
+    """
+    source: Callable[[], AsyncIterator[CapturedFrame]]
+    max_queued: int = 2
+
+    _subscribers: set[asyncio.Queue] = field(default_factory=set, init=False, repr=False)
+    _task: asyncio.Task | None = field(default=None, init=False, repr=False)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    async def subscribe(self):
+        """
+        Yield frames from the shared source. Close the generator, e.g. with contextlib.aclosing, to unsubscribe.
+        """
+        queue = asyncio.Queue(self.max_queued)
+        self._subscribers.add(queue)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        try:
+            while True:
+                item = await queue.get()
+
+                if item is None:
+                    return
+
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+
+        finally:
+            self._subscribers.discard(queue)
+
+            if not self._subscribers and self._task is not None:
+                self._task.cancel()
+                self._task = None
+
+    async def _run(self):
+        try:
+            async for frame in self.source():
+                self._publish(frame)
+
+        except Exception as e:
+            self._publish(e)
+
+        else:
+            # The source ended; let subscribers finish.
+            self._publish(None)
+
+    def _publish(self, item: CapturedFrame | Exception | None):
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+
+            queue.put_nowait(item)
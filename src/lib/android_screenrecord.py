@@ -0,0 +1,114 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+
+from src.lib.adb import AdbDevice
+from src.lib.android_capture import CapturedFrame
+
+
+@dataclass
+class H264Decoder:
+    """
+    Decodes an H.264 elementary stream incrementally: feed it bytes as they arrive and it returns the frames completed
+    so far, as BGR images. Needs PyAV, which is only imported once a decoder is created.
+    """
+    _codec: Any = field(init=False, repr=False)
+
+    def __post_init__(self):
+        import av
+
+        self._codec = av.CodecContext.create('h264', 'r')
+
+    def feed(self, data: bytes) -> list[np.ndarray]:
+        frames = []
+
+        for packet in self._codec.parse(data):
+            frames.extend(self._decode(packet))
+
+        return frames
+
+    def flush(self) -> list[np.ndarray]:
+        """
+        Return the frames still held back by the parser and decoder at the end of a stream.
+        """
+        frames = []
+
+        for packet in self._codec.parse(None):
+            frames.extend(self._decode(packet))
+
+        frames.extend(self._decode(None))
+
+        return frames
+
+    def _decode(self, packet) -> list[np.ndarray]:
+        return [
+            frame.to_ndarray(format='bgr24')
+            for frame in self._codec.decode(packet)
+        ]
+
+
+def decode_file(path: str | Path, chunk_size: int = 2 ** 16) -> Iterator[np.ndarray]:
+    """
+    Decode a recorded .h264 file chunk by chunk, the same way a live stream is decoded.
+    """
+    decoder = H264Decoder()
+
+    with open(path, 'rb') as file:
+        while chunk := file.read(chunk_size):
+            yield from decoder.feed(chunk)
+
+    yield from decoder.flush()
+
+
+@dataclass
+class ScreenRecordSource:
+    """
+    A live frame source that runs `screenrecord` on the device and decodes its H.264 output as it arrives. It delivers
+    frames as fast as the screen changes instead of the few per second that polling screenshots allows.
+    """
+    adb: AdbDevice
+    bit_rate: int = 8_000_000
+    size: tuple[int, int] | None = None
+    chunk_size: int = 2 ** 16
+
+    @property
+    def command(self) -> str:
+        options = [f'--bit-rate {self.bit_rate}', '--output-format=h264']
+
+        if self.size:
+            options.append(f'--size {self.size[0]}x{self.size[1]}')
+
+        return f'screenrecord {" ".join(options)} -'
+
+    async def frames(self):
+        """
+        Yield decoded frames as CapturedFrames. Their timestamps are the time.monotonic() at which the data completing
+        them arrived, so they trail the screen by the encoder's latency.
+        """
+        index = 0
+
+        # screenrecord stops on its own after its time limit of a few minutes, so a new recording is started each time.
+        while True:
+            decoder = H264Decoder()
+            start = index
+
+            async for chunk in self.adb.stream(self.command, self.chunk_size):
+                timestamp = time.monotonic()
+
+                for image in await asyncio.to_thread(decoder.feed, chunk):
+                    index += 1
+                    yield CapturedFrame.from_image(image, timestamp, index)
+
+            # The last frames of a recording are still held back by the decoder when its stream ends.
+            timestamp = time.monotonic()
+
+            for image in await asyncio.to_thread(decoder.flush):
+                index += 1
+                yield CapturedFrame.from_image(image, timestamp, index)
+
+            if index == start:
+                raise Exception(f'screenrecord produced no frames: {self.command}')
@@ -1,4 +1,7 @@
-from typing import TypeVar, Iterable
+import asyncio
+import weakref
+from dataclasses import dataclass, field
+from typing import Callable, Generic, TypeVar, Iterable
 
 import numpy as np
 
@@ -9,3 +12,31 @@ undefined = object()
 
 def flatten(list_of_lists: list[Iterable[_T]]) -> list[_T]:
     return np.array([list(list_) for list_ in list_of_lists]).flatten().tolist()
+
+
+@dataclass
+class PerLoop(Generic[_T]):
+    """
+    One value per running event loop, created by `factory` on first use, for objects such as sessions, tasks and
+    conditions that belong to the loop they were created on. A value is dropped along with its loop, and replaced when
+    `is_stale` says it can't be used anymore.
+    """
+    factory: Callable[[], _T]
+    is_stale: Callable[[_T], bool] | None = None
+
+    _values: weakref.WeakKeyDictionary = field(default_factory=weakref.WeakKeyDictionary, init=False, repr=False)
+
+    def get(self) -> _T:
+        loop = asyncio.get_running_loop()
+        value = self._values.get(loop)
+
+        if value is None or (self.is_stale is not None and self.is_stale(value)):
+            value = self._values[loop] = self.factory()
+
+        return value
+
+    def pop(self) -> _T | None:
+        return self._values.pop(asyncio.get_running_loop(), None)
+
+    def items(self) -> list[tuple[asyncio.AbstractEventLoop, _T]]:
+        return list(self._values.items())
@@ -22,3 +22,45 @@ def get_adb_alias():
         'ADB_ALIAS',
         './adb'
     )
+
+
+def get_adb_shell_pool_size():
+    return int(get_env(
+        'ADB_SHELL_POOL_SIZE',
+        '2'
+    ))
+
+
+def get_adb_touch_backend():
+    return get_env(
+        'ADB_TOUCH_BACKEND',
+        'input'
+    )
+
+
+def get_adb_serial():
+    return get_env(
+        'ADB_SERIAL',
+        None
+    )
+
+
+def get_adb_server_port():
+    return int(get_env(
+        'ANDROID_ADB_SERVER_PORT',
+        '5037'
+    ))
+
+
+def get_vision_workers():
+    return int(get_env(
+        'VISION_WORKERS',
+        str(os.cpu_count() or 1)
+    ))
+
+
+def get_adb_shell_timeout():
+    return float(get_env(
+        'ADB_SHELL_TIMEOUT',
+        '30'
+    ))
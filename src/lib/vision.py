@@ -1,18 +1,37 @@
-from dataclasses import dataclass
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from typing import Iterator, Literal
+from typing import Any, Callable, Hashable, Iterable, Iterator, Literal, Mapping
 
 import cv2
 import numpy as np
 
+from src.lib.env import get_vision_workers
 
-@dataclass
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+@dataclass(slots=True)
 class Rectangle:
     x: int
     y: int
     w: int
     h: int
 
+    # Rectangles aren't changed after they are made, so their corner and center Points are built once, on first use.
+    _top_left: 'Point | None' = field(default=None, init=False, repr=False, compare=False)
+    _bottom_right: 'Point | None' = field(default=None, init=False, repr=False, compare=False)
+    _center: 'Point | None' = field(default=None, init=False, repr=False, compare=False)
+
     def __iter__(self):
         return iter((self.x, self.y, self.w, self.h))
 
@@ -20,49 +39,65 @@ class Rectangle:
         if isinstance(item, int):
             return (self.x, self.y, self.w, self.h)[item]
 
-        if item == 'x':
-            return self.x
+        if item in ('x', 'y', 'w', 'h'):
+            return getattr(self, item)
 
-        if item == 'y':
-            return self.y
+        raise KeyError(f'Invalid key: {item}')
 
-        if item == 'w':
-            return self.w
+    @property
+    def left(self) -> int:
+        return self.x
 
-        if item == 'h':
-            return self.h
+    @property
+    def top(self) -> int:
+        return self.y
 
-        raise KeyError(f'Invalid key: {item}')
+    @property
+    def right(self) -> int:
+        return self.x + self.w
+
+    @property
+    def bottom(self) -> int:
+        return self.y + self.h
 
     @property
     def top_left(self):
-        return Point(self.x, self.y)
+        if self._top_left is None:
+            self._top_left = Point(self.x, self.y)
+
+        return self._top_left
 
     @property
     def bottom_right(self):
-        return Point(self.x + self.w, self.y + self.h)
+        if self._bottom_right is None:
+            self._bottom_right = Point(self.x + self.w, self.y + self.h)
+
+        return self._bottom_right
 
     @property
     def center(self):
-        return Point(
-            (self.x + self.x + self.w) // 2,
-            (self.y + self.y + self.h) // 2
-        )
+        if self._center is None:
+            self._center = Point(
+                (self.x + self.x + self.w) // 2,
+                (self.y + self.y + self.h) // 2
+            )
+
+        return self._center
 
     def is_above(self, other):
-        return self.bottom_right.y < other.top_left.y
+        return self.bottom < other.top
 
     def is_below(self, other):
-        return self.top_left.y > other.bottom_right.y
+        return self.top > other.bottom
 
     def is_left_of(self, other):
-        return self.bottom_right.x < other.top_left.x
+        return self.right < other.left
 
     def is_right_of(self, other):
-        return self.top_left.x > other.bottom_right.x
+        return self.left > other.right
 
 
-@dataclass
+@dataclass(slots=True)
 class Point:
     x: int
     y: int
@@ -74,16 +109,13 @@ class Point:
         if isinstance(item, int):
             return (self.x, self.y)[item]
 
-        if item == 'x':
-            return self.x
-
-        if item == 'y':
-            return self.y
+        if item in ('x', 'y'):
+            return getattr(self, item)
 
         raise KeyError(f'Invalid key: {item}')
 
 
-@dataclass
+@dataclass(slots=True)
 class Match:
     top_left: Point
     bottom_right: Point
@@ -100,6 +132,22 @@ class Match:
     def __iter__(self):
         return iter((self.top_left, self.bottom_right))
 
+    @property
+    def left(self) -> int:
+        return self.top_left.x
+
+    @property
+    def top(self) -> int:
+        return self.top_left.y
+
+    @property
+    def right(self) -> int:
+        return self.bottom_right.x
+
+    @property
+    def bottom(self) -> int:
+        return self.bottom_right.y
+
     @property
     def rectangle(self):
         return Rectangle(
@@ -110,10 +158,523 @@ class Match:
         )
 
 
+@dataclass
+class MatchSet:
+    """
+    Matches stored as arrays instead of one object each: `boxes` holds (x1, y1, x2, y2) rows and `scores` their
+    confidences. Geometry, sorting and filtering work on all matches at once; indexing with an int returns a Match, and
+    with a slice, index array or boolean mask returns another MatchSet.
+    """
+    boxes: np.ndarray
+    scores: np.ndarray
+
+    @classmethod
+    def empty(cls) -> 'MatchSet':
+        return cls(np.empty((0, 4), np.int32), np.empty(0, np.float32))
+
+    @classmethod
+    def from_matches(cls, matches: Iterable[Match]) -> 'MatchSet':
+        if isinstance(matches, MatchSet):
+            return matches
+
+        matches = list(matches)
+
+        return cls(
+            np.array([[*match.top_left, *match.bottom_right] for match in matches], np.int32).reshape(-1, 4),
+            np.array([match.confidence or 0 for match in matches], np.float32)
+        )
+
+    @classmethod
+    def from_rectangles(cls, rectangles: Iterable[Rectangle]) -> 'MatchSet':
+        boxes = np.array([[x, y, x + w, y + h] for x, y, w, h in rectangles], np.int32).reshape(-1, 4)
+        return cls(boxes, np.zeros(len(boxes), np.float32))
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __iter__(self) -> Iterator[Match]:
+        for (x1, y1, x2, y2), score in zip(self.boxes.tolist(), self.scores.tolist()):
+            yield Match(Point(x1, y1), Point(x2, y2), score)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            x1, y1, x2, y2 = self.boxes[item].tolist()
+            return Match(Point(x1, y1), Point(x2, y2), float(self.scores[item]))
+
+        return MatchSet(self.boxes[item], self.scores[item])
+
+    @property
+    def top_left(self) -> np.ndarray:
+        return self.boxes[:, :2]
+
+    @property
+    def bottom_right(self) -> np.ndarray:
+        return self.boxes[:, 2:]
+
+    @property
+    def size(self) -> np.ndarray:
+        return self.boxes[:, 2:] - self.boxes[:, :2]
+
+    @property
+    def center(self) -> np.ndarray:
+        return (self.boxes[:, :2] + self.boxes[:, 2:]) // 2
+
+    def is_above(self, other) -> np.ndarray:
+        return self.boxes[:, 3] < other.top
+
+    def is_below(self, other) -> np.ndarray:
+        return self.boxes[:, 1] > other.bottom
+
+    def is_left_of(self, other) -> np.ndarray:
+        return self.boxes[:, 2] < other.left
+
+    def is_right_of(self, other) -> np.ndarray:
+        return self.boxes[:, 0] > other.right
+
+    def sort(self, by: Literal['score', 'x', 'y'] = 'score', descending: bool = None) -> 'MatchSet':
+        """
+        Sort by score, best first by default, or by the x or y of the centers, smallest first by default.
+        """
+        keys = self.scores if by == 'score' else self.center[:, 'xy'.index(by)]
+        order = np.argsort(keys, kind='stable')
+
+        if descending if descending is not None else by == 'score':
+            order = order[::-1]
+
+        return self[order]
+
+    def filter(self, mask: np.ndarray = None, min_score: float = None) -> 'MatchSet':
+        keep = np.ones(len(self), bool) if mask is None else np.asarray(mask, bool)
+
+        if min_score is not None:
+            keep &= self.scores >= min_score
+
+        return self[keep]
+
+    def suppress(self, iou_threshold: float = .3) -> 'MatchSet':
+        """
+        Drop matches that overlap a more confident one, see `non_max_suppression`.
+        """
+        return self[non_max_suppression(self.boxes, self.scores, iou_threshold)]
+
+    def to_rectangles(self) -> list[Rectangle]:
+        return [Rectangle(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in self.boxes.tolist()]
+
+
+# A region of interest as a Rectangle or an (x, y, w, h) tuple, in full-frame coordinates.
+Roi = Rectangle | tuple[int, int, int, int]
+
+# A detector looks at an image and returns what it found, or None when it found nothing.
+Detector = Callable[['np.ndarray | Frame'], Any]
+
+
+def expect(match_fn: Callable[[np.ndarray], Iterable], count: int | None = 1) -> Detector:
+    """
+    Turn a template matcher into a detector that hits when it finds exactly `count` matches, or at least one when
+    `count` is None, and returns them as a list.
+    """
+    def detector(image: 'np.ndarray | Frame'):
+        matches = list(match_fn(image))
+
+        if (count is None and matches) or len(matches) == count:
+            return matches
+
+        return None
+
+    return detector
+
+
+def any_of(*detectors: Detector) -> Detector:
+    """
+    Hit when any detector hits and return its index together with its result, as `(index, result)`.
+    """
+    def detector(image: 'np.ndarray | Frame'):
+        for i, detector_ in enumerate(detectors):
+            result = detector_(image)
+
+            if result is not None:
+                return i, result
+
+        return None
+
+    return detector
+
+
+def all_of(*detectors: Detector) -> Detector:
+    """
+    Hit when every detector hits on the same image and return their results in order.
+    """
+    def detector(image: 'np.ndarray | Frame'):
+        results = []
+
+        for detector_ in detectors:
+            result = detector_(image)
+
+            if result is None:
+                return None
+
+            results.append(result)
+
+        return results
+
+    return detector
+
+
+@dataclass
+class Template:
+    path: str
+    image: np.ndarray
+    mask: np.ndarray | None
+    mtime: float
+
+    _scaled: dict[float, 'Template'] = field(default_factory=dict, init=False, repr=False)
+
+    @property
+    def size(self) -> tuple[int, int]:
+        h, w = self.image.shape[:2]
+        return w, h
+
+    def scaled(self, scale: float) -> 'Template':
+        if scale == 1:
+            return self
+
+        template = self._scaled.get(scale)
+
+        if template is None:
+            w, h = self.size
+            size = (max(round(w * scale), 1), max(round(h * scale), 1))
+
+            template = self._scaled[scale] = Template(
+                self.path,
+                cv2.resize(self.image, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR),
+                None if self.mask is None else cv2.resize(self.mask, size, interpolation=cv2.INTER_NEAREST),
+                self.mtime
+            )
+
+        return template
+
+
+@dataclass
+class TemplateRegistry:
+    """
+    Loads every template once and keeps its grayscale image and alpha mask, reloading it when the file's mtime changes.
+    Matching runs on worker threads, so lookups are guarded by a lock.
+    """
+    _templates: dict[str, Template] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def get(self, path: str | Path) -> Template:
+        path = Path(path).as_posix()
+        mtime = os.stat(path).st_mtime
+
+        with self._lock:
+            template = self._templates.get(path)
+
+            if template is None or template.mtime != mtime:
+                template = self._templates[path] = load_template(path, mtime)
+
+            return template
+
+    def preload(self, directory: str | Path, pattern: str = '**/*.png'):
+        for path in Path(directory).glob(pattern):
+            self.get(path)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+def load_template(path: str | Path, mtime: float = None) -> Template:
+    path = Path(path).as_posix()
+
+    template = cv2.imread(
+        path,
+        cv2.IMREAD_UNCHANGED
+    )
+
+    assert template is not None, f'Could not read template from path: {path}'
+
+    mask = get_alpha_mask(template) if template.ndim == 3 and template.shape[2] == 4 else None
+
+    if template.ndim == 3:
+        template = cv2.cvtColor(
+            template,
+            cv2.COLOR_BGR2GRAY if template.shape[2] == 3 else cv2.COLOR_BGRA2GRAY
+        )
+
+    return Template(
+        path,
+        template,
+        mask,
+        os.stat(path).st_mtime if mtime is None else mtime
+    )
+
+
+template_registry = TemplateRegistry()
+
+
+def get_template(path: str | Path) -> Template:
+    return template_registry.get(path)
+
+
+DEFAULT_SCALES = tuple(round(.5 + i * .05, 2) for i in range(21))
+
+
+def find_best_scale(
+        image: 'np.ndarray | Frame',
+        template: Template,
+        method: int = cv2.TM_CCOEFF_NORMED,
+        use_mask: bool = False,
+        roi: Roi = None,
+        scales: Iterable[float] = DEFAULT_SCALES
+) -> tuple[float, float]:
+    """
+    Match a template at every scale and return the scale with the best score, together with that score.
+    """
+    image, _ = Frame.of(image).crop(roi)
+    best_scale, best_score = 1, float('-inf')
+
+    for scale in scales:
+        scaled = template.scaled(scale)
+        h, w = scaled.image.shape[:2]
+
+        if image.shape[0] < h or image.shape[1] < w:
+            continue
+
+        result = cv2.matchTemplate(
+            image,
+            scaled.image,
+            method,
+            None,
+            scaled.mask if use_mask else None
+        )
+
+        score = float(np.where(np.isfinite(result), result, 0).max())
+
+        if score > best_score:
+            best_scale, best_score = scale, score
+
+    return best_scale, best_score
+
+
+@dataclass
+class ScaleCalibration:
+    """
+    The scale templates match at on one device, saved to `path`. The whole UI is drawn at one scale, so the first
+    template found by a sweep over `scales` sets the scale for every template that hasn't been calibrated itself, and
+    the sweep doesn't run again for each template that is off screen. A template that keeps missing at its scale is
+    swept again every `recheck_after` misses, so a scale fixed by a wrong match is replaced once the template shows up
+    at another one.
+    """
+    path: Path
+    scales: tuple[float, ...] = DEFAULT_SCALES
+    recheck_after: int = 50
+    # Seconds before a template that wasn't found at any scale is swept again, while no scale is known yet.
+    retry_interval: float = 1
+
+    _entries: dict[str, dict] = field(default_factory=dict, init=False, repr=False)
+    _misses: dict[str, int] = field(default_factory=dict, init=False, repr=False)
+    _swept_at: dict[str, float] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def __post_init__(self):
+        self.path = Path(self.path)
+
+        if self.path.exists():
+            self._entries = json.loads(self.path.read_text())
+
+    @property
+    def scale(self) -> float | None:
+        """
+        The device's scale, taken from the template that matched with the best score.
+        """
+        best = max(self._entries.values(), key=lambda entry: entry['score'], default=None)
+        return best and best['scale']
+
+    def get(self, template: Template) -> float | None:
+        entry = self._entries.get(template.path)
+        return entry['scale'] if entry else self.scale
+
+    def record(self, template: Template, found: bool) -> bool:
+        """
+        Record whether the template matched at its scale. Returns True when it has missed often enough in a row that
+        it should be swept again.
+        """
+        with self._lock:
+            misses = 0 if found else self._misses.get(template.path, 0) + 1
+            self._misses[template.path] = misses % self.recheck_after
+
+        return misses == self.recheck_after
+
+    def calibrate(
+            self,
+            image: 'np.ndarray | Frame',
+            template: Template,
+            threshold: float = 0.8,
+            method: int = cv2.TM_CCOEFF_NORMED,
+            use_mask: bool = False,
+            roi: Roi = None
+    ) -> float | None:
+        """
+        Find and save the template's scale. Returns None without saving anything when the template isn't on screen at
+        any scale. Until some scale is known, such a template isn't swept again for `retry_interval`.
+        """
+        swept_at = self._swept_at.get(template.path, float('-inf'))
+
+        if self.scale is None and time.monotonic() - swept_at < self.retry_interval:
+            return None
+
+        self._swept_at[template.path] = time.monotonic()
+        scale, score = find_best_scale(image, template, method, use_mask, roi, self.scales)
+
+        if score < threshold:
+            return None
+
+        with self._lock:
+            self._entries[template.path] = {'scale': scale, 'score': score}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(self._entries, indent=4))
+
+        return scale
+
+
+_calibration: contextvars.ContextVar[ScaleCalibration | None] = contextvars.ContextVar('calibration', default=None)
+
+
+@contextmanager
+def use_calibration(calibration: ScaleCalibration | None):
+    """
+    Match templates at their calibrated scales within this block. Context variables follow `asyncio.to_thread`, so a
+    device can set its calibration around detectors it runs on worker threads.
+    """
+    token = _calibration.set(calibration)
+
+    try:
+        yield calibration
+
+    finally:
+        _calibration.reset(token)
+
+
 def crop(image, x, y, w, h):
     return image[y:y + h, x:x + w]
 
 
+def get_roi(x: int, y: int, w: int, h: int, anchor: Rectangle | Match = None) -> Rectangle:
+    """
+    Build a region of interest. With an `anchor`, such as a dialog's layout match, `x` and `y` are offsets from the
+    anchor's top left corner, so the region follows the anchor around the screen.
+    """
+    if anchor is not None:
+        x += anchor.top_left.x
+        y += anchor.top_left.y
+
+    return Rectangle(x, y, w, h)
+
+
+def crop_roi(image: np.ndarray, roi: Roi | None) -> tuple[np.ndarray, Point]:
+    """
+    Crop an image to a region of interest clipped to the image, and return the crop with its offset in the image.
+    """
+    if roi is None:
+        return image, Point(0, 0)
+
+    x, y, w, h = roi
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, image.shape[1]), min(y + h, image.shape[0])
+
+    return image[y1:max(y2, y1), x1:max(x2, x1)], Point(x1, y1)
+
+
+@dataclass
+class Frame:
+    """
+    A screenshot that computes what detectors derive from it, such as its grayscale image, pyramid levels, region
+    crops and integral images, the first time one asks and shares the result with all others. Matching functions
+    accept a Frame wherever they accept an image, and match against its grayscale image.
+    """
+    image: np.ndarray
+
+    _cache: dict = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False)
+
+    @classmethod
+    def of(cls, image: 'np.ndarray | Frame') -> 'Frame':
+        return image if isinstance(image, Frame) else cls(image)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.image.shape
+
+    @property
+    def gray(self) -> np.ndarray:
+        if self.image.ndim == 2:
+            return self.image
+
+        return self._memoize('gray', lambda: cv2.cvtColor(
+            self.image,
+            cv2.COLOR_BGR2GRAY if self.image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY
+        ))
+
+    @property
+    def hsv(self) -> np.ndarray:
+        assert self.image.ndim == 3, 'HSV needs a colour frame.'
+
+        return self._memoize('hsv', lambda: cv2.cvtColor(
+            self.image if self.image.shape[2] == 3 else cv2.cvtColor(self.image, cv2.COLOR_BGRA2BGR),
+            cv2.COLOR_BGR2HSV
+        ))
+
+    def pyramid(self, level: int) -> np.ndarray:
+        """
+        The grayscale image halved `level` times.
+        """
+        if level == 0:
+            return self.gray
+
+        return self._memoize(('pyramid', level), lambda: cv2.pyrDown(self.pyramid(level - 1)))
+
+    def crop(self, roi: Roi | None, level: int = 0) -> tuple[np.ndarray, Point]:
+        """
+        Crop a pyramid level, the grayscale image by default, to a region of interest; see `crop_roi`.
+        """
+        if roi is None:
+            return self.pyramid(level), Point(0, 0)
+
+        return self._memoize(('crop', level, tuple(roi)), lambda: crop_roi(self.pyramid(level), roi))
+
+    def integral(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The integral image and squared integral image of the grayscale image.
+        """
+        return self._memoize('integral', lambda: cv2.integral2(self.gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F))
+
+    def get_stats(self, roi: Roi) -> tuple[float, float]:
+        """
+        The mean and standard deviation of a region of the grayscale image, in constant time.
+        """
+        total, squared = self.integral()
+        image, (x1, y1) = crop_roi(self.gray, roi)
+        x2, y2 = x1 + image.shape[1], y1 + image.shape[0]
+        n = max(image.size, 1)
+
+        s = total[y2, x2] - total[y1, x2] - total[y2, x1] + total[y1, x1]
+        sq = squared[y2, x2] - squared[y1, x2] - squared[y2, x1] + squared[y1, x1]
+        mean = s / n
+
+        return float(mean), float(np.sqrt(max(sq / n - mean ** 2, 0)))
+
+    def _memoize(self, key, compute: Callable[[], Any]):
+        # Matchers share frames across worker threads; the lock makes sure each product is computed only once.
+        with self._lock:
+            value = self._cache.get(key)
+
+            if value is None:
+                value = self._cache[key] = compute()
+
+            return value
+
+
 def get_alpha_mask(template: np.ndarray):
     assert template.shape[2] == 4, 'Template must have 4 channels.'
 
@@ -129,17 +690,60 @@ def get_alpha_mask(template: np.ndarray):
 
 
 def match_template(
-        image,
+        image: 'np.ndarray | Frame',
         template,
         threshold: float = 0.9,
         method: int = cv2.TM_CCOEFF_NORMED,
         mask: np.ndarray = None,
-        filter_inf: bool = True
+        filter_inf: bool = True,
+        roi: Roi = None,
+        pyramid_levels: int = 0,
+        refine_margin: int = 4
 ) -> Iterator[Match]:
     """
-    Match a template in an image and return an iterator of top left and bottom right points of the matches.
+    Match a template in an image and return an iterator of top left and bottom right points of the matches. With a
+    `roi` only that region is searched, but matches are still in full-frame coordinates. With `pyramid_levels` the
+    search runs coarse-to-fine, see `match_template_pyramid`.
     """
-    w, h = template.shape[::-1]
+    if pyramid_levels:
+        yield from match_template_pyramid(
+            image,
+            template,
+            threshold,
+            method,
+            mask,
+            filter_inf,
+            roi,
+            pyramid_levels,
+            refine_margin
+        )
+
+        return
+
+    yield from MatchSet(*detect_template(image, template, threshold, method, mask, filter_inf, roi))
+
+
+def detect_template(
+        image: 'np.ndarray | Frame',
+        template: np.ndarray,
+        threshold: float = 0.9,
+        method: int = cv2.TM_CCOEFF_NORMED,
+        mask: np.ndarray = None,
+        filter_inf: bool = True,
+        roi: Roi = None,
+        iou_threshold: float = .3
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Match a template and return one detection per object as compact arrays: boxes as (x1, y1, x2, y2) rows in
+    full-frame coordinates and their scores, best first. Only local maxima of the match result are considered and
+    overlapping ones are suppressed, so the cost follows the number of objects, not the number of pixels above
+    `threshold`.
+    """
+    h, w = template.shape[:2]
+    image, offset = Frame.of(image).crop(roi)
+
+    if image.shape[0] < h or image.shape[1] < w:
+        return np.empty((0, 4), np.int32), np.empty(0, np.float32)
 
     result = cv2.matchTemplate(
         image,
@@ -149,69 +753,328 @@ def match_template(
         mask
     )
 
+    if filter_inf:
+        result = np.where(np.isfinite(result), result, 0).astype(np.float32)
+
+    points, scores = find_peaks(result, threshold)
+    points += (offset.x, offset.y)
+    boxes = np.hstack([points, points + (w, h)])
+    keep = non_max_suppression(boxes, scores, iou_threshold)
+
+    return boxes[keep], scores[keep]
+
+
+def find_peaks(result: np.ndarray, threshold: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the (x, y) positions of the local maxima in a match result that reach `threshold`, and their scores.
+    """
+    above = result >= threshold
+
+    if not above.any():
+        return np.empty((0, 2), np.int32), np.empty(0, np.float32)
+
+    neighbourhood = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    ys, xs = np.nonzero(above & (result >= cv2.dilate(result, neighbourhood)))
+
+    return np.stack([xs, ys], axis=1).astype(np.int32), result[ys, xs].astype(np.float32)
+
+
+def non_max_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = .3) -> np.ndarray:
+    """
+    Greedy non-maximum suppression: visit boxes from the highest score down and drop every box that overlaps an
+    already kept one by more than `iou_threshold`. Returns the indices of the kept boxes, best first.
+    """
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    x1, y1, x2, y2 = np.asarray(boxes, np.float64).T
+    areas = (x2 - x1) * (y2 - y1)
+    keep = []
+
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+
+        overlap_w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        overlap_h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        intersection = overlap_w * overlap_h
+        iou = intersection / np.maximum(areas[i] + areas[rest] - intersection, 1e-9)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, np.intp)
+
+
+def match_template_pyramid(
+        image: 'np.ndarray | Frame',
+        template: np.ndarray,
+        threshold: float = 0.9,
+        method: int = cv2.TM_CCOEFF_NORMED,
+        mask: np.ndarray = None,
+        filter_inf: bool = True,
+        roi: Roi = None,
+        levels: int = 2,
+        refine_margin: int = 4,
+        coarse_threshold: float = None
+) -> Iterator[Match]:
+    """
+    Match a template coarse-to-fine. The image and template are first halved `levels` times and matched against each
+    other, then every group of candidates scoring at least `coarse_threshold` is matched again at full resolution in a
+    window that extends `refine_margin` pixels around it. Cost scales with the number of candidates rather than the
+    number of pixels. Downscaling lowers scores, so `coarse_threshold` defaults to a little below `threshold`.
+    """
+    frame = Frame.of(image)
+    h, w = template.shape[:2]
+
+    # Keep the coarse template large enough to still be recognizable.
+    while levels and min(w, h) >> levels < 8:
+        levels -= 1
+
+    if not levels:
+        yield from match_template(frame, template, threshold, method, mask, filter_inf, roi)
+        return
+
+    image, offset = frame.crop(roi)
+
+    if image.shape[0] < h or image.shape[1] < w:
+        return
+
+    scale = 1 << levels
+
+    # The frame's pyramid level is shared with every other coarse search on it, so only the region is cropped from it.
+    coarse_roi = None if roi is None else (
+        offset.x // scale,
+        offset.y // scale,
+        -(-image.shape[1] // scale),
+        -(-image.shape[0] // scale)
+    )
+
+    coarse_image, coarse_offset = frame.crop(coarse_roi, level=levels)
+    coarse_template = template
+
+    for _ in range(levels):
+        coarse_template = cv2.pyrDown(coarse_template)
+
+    if coarse_image.shape[0] < coarse_template.shape[0] or coarse_image.shape[1] < coarse_template.shape[1]:
+        return
+
+    coarse_mask = None if mask is None else cv2.resize(
+        mask,
+        coarse_template.shape[::-1],
+        interpolation=cv2.INTER_NEAREST
+    )
+
+    result = cv2.matchTemplate(
+        coarse_image,
+        coarse_template,
+        method,
+        None,
+        coarse_mask
+    )
+
     if filter_inf:
         result = np.where(np.isfinite(result), result, 0)
 
-    locations = np.where(result >= threshold)
+    candidates = (result >= (threshold - .15 if coarse_threshold is None else coarse_threshold)).astype(np.uint8)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(candidates)
 
-    for point in zip(*locations[::-1]):
-        confidence = result[point[1], point[0]]
+    seen = set()
 
-        yield Match(
-            Point(*point),
-            Point(point[0] + w, point[1] + h),
-            float(confidence)
-        )
+    # Component 0 is the background.
+    for x, y, cw, ch, _ in stats[1:count].tolist():
+        x, y = x + coarse_offset.x, y + coarse_offset.y
 
+        # The refine window in full-frame coordinates, kept inside the searched region.
+        x1 = max(x * scale - refine_margin, offset.x)
+        y1 = max(y * scale - refine_margin, offset.y)
+        x2 = min((x + cw - 1) * scale + refine_margin + w, offset.x + image.shape[1])
+        y2 = min((y + ch - 1) * scale + refine_margin + h, offset.y + image.shape[0])
 
-def match_template_from_path(
-        image: np.ndarray,
+        # Windows of neighbouring groups can overlap, so skip matches that were already found.
+        for match in match_template(frame, template, threshold, method, mask, filter_inf, (x1, y1, x2 - x1, y2 - y1)):
+            if tuple(match.top_left) not in seen:
+                seen.add(tuple(match.top_left))
+                yield match
+
+
+def detect_template_from_path(
+        image: 'np.ndarray | Frame',
         path: str | Path,
         threshold: float = 0.8,
         method: int = cv2.TM_CCOEFF_NORMED,
         use_mask: bool = False,
-        filter_inf: bool = True
-):
-    path = Path(path).as_posix()
+        filter_inf: bool = True,
+        roi: Roi = None,
+        pyramid_levels: int = 0,
+        refine_margin: int = 4,
+        iou_threshold: float = .3
+) -> MatchSet:
+    """
+    Match a template file, at its calibrated scale within `use_calibration`, and return one match per object as a
+    MatchSet, best first.
+    """
+    template = get_template(path)
 
-    template = cv2.imread(
-        path,
-        cv2.IMREAD_UNCHANGED
-    )
+    assert not use_mask or template.mask is not None, 'Template must have 4 channels.'
 
-    assert template is not None, f'Could not read template from path: {path}'
+    def detect(template: Template) -> MatchSet:
+        mask = template.mask if use_mask else None
 
-    template_mask = get_alpha_mask(template) if use_mask else None
+        if pyramid_levels:
+            return MatchSet.from_matches(match_template_pyramid(
+                image,
+                template.image,
+                threshold,
+                method,
+                mask,
+                filter_inf,
+                roi,
+                pyramid_levels,
+                refine_margin
+            ))
 
-    template = cv2.cvtColor(
-        template,
-        cv2.COLOR_BGR2GRAY
-    )
+        return MatchSet(*detect_template(
+            image,
+            template.image,
+            threshold,
+            method,
+            mask,
+            filter_inf,
+            roi,
+            iou_threshold
+        ))
+
+    calibration = _calibration.get()
+
+    if calibration is None:
+        return detect(template)
+
+    scale = calibration.get(template)
 
-    yield from match_template(
+    if scale is not None:
+        matches = detect(template.scaled(scale))
+
+        if not calibration.record(template, len(matches) > 0):
+            return matches
+
+    new_scale = calibration.calibrate(image, template, threshold, method, use_mask, roi)
+
+    if new_scale is not None and new_scale != scale:
+        return detect(template.scaled(new_scale))
+
+    return MatchSet.empty()
+
+
+def match_template_from_path(
+        image: 'np.ndarray | Frame',
+        path: str | Path,
+        threshold: float = 0.8,
+        method: int = cv2.TM_CCOEFF_NORMED,
+        use_mask: bool = False,
+        filter_inf: bool = True,
+        roi: Roi = None,
+        pyramid_levels: int = 0,
+        refine_margin: int = 4
+):
+    yield from detect_template_from_path(
         image,
-        template,
+        path,
         threshold,
         method,
-        template_mask,
-        filter_inf
+        use_mask,
+        filter_inf,
+        roi,
+        pyramid_levels,
+        refine_margin
     )
 
 
 def match_templates_from_paths(
-        image: np.ndarray,
+        image: 'np.ndarray | Frame',
         paths: list[str | Path],
         threshold: float = 0.8,
         method: int = cv2.TM_CCOEFF_NORMED,
         use_mask: bool = False,
-        filter_inf: bool = True
+        filter_inf: bool = True,
+        roi: Roi = None,
+        pyramid_levels: int = 0,
+        refine_margin: int = 4
 ):
-    for path in paths:
-        yield from match_template_from_path(
-            image,
-            path,
-            threshold,
-            method,
-            use_mask,
-            filter_inf
-        )
+    results = match_many(
+        image,
+        paths,
+        threshold=threshold,
+        method=method,
+        use_mask=use_mask,
+        filter_inf=filter_inf,
+        roi=roi,
+        pyramid_levels=pyramid_levels,
+        refine_margin=refine_margin
+    )
+
+    for matches in results.values():
+        yield from matches
+
+
+def match_many(
+        image: 'np.ndarray | Frame',
+        templates: Mapping[Hashable, Callable[[np.ndarray], Iterable]] | Iterable[str | Path],
+        **kwargs
+) -> dict[Hashable, list]:
+    """
+    Run several matchers on one image in parallel on the vision thread pool; cv2.matchTemplate releases the GIL, so
+    they use separate cores. `templates` is either a mapping of keys to matchers such as the `templates.py` functions,
+    or template paths, which are matched with `match_template_from_path` and `kwargs`. Results are keyed the same way.
+    Don't call it from a matcher already running on the pool, which could wait on itself.
+    """
+    executor = get_executor()
+
+    futures = {
+        key: executor.submit(_run_matcher, contextvars.copy_context(), matcher, image)
+        for key, matcher in _get_matchers(templates, kwargs).items()
+    }
+
+    return {key: future.result() for key, future in futures.items()}
+
+
+async def match_many_async(
+        image: 'np.ndarray | Frame',
+        templates: Mapping[Hashable, Callable[[np.ndarray], Iterable]] | Iterable[str | Path],
+        **kwargs
+) -> dict[Hashable, list]:
+    """
+    Like `match_many`, but awaits the pool instead of blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    matchers = _get_matchers(templates, kwargs)
+
+    results = await asyncio.gather(*(
+        loop.run_in_executor(executor, _run_matcher, contextvars.copy_context(), matcher, image)
+        for matcher in matchers.values()
+    ))
+
+    return dict(zip(matchers, results))
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(get_vision_workers(), thread_name_prefix='vision')
+
+        return _executor
+
+
+def _get_matchers(templates, kwargs: dict) -> dict[Hashable, Callable[[np.ndarray], Iterable]]:
+    if isinstance(templates, Mapping):
+        return dict(templates)
+
+    return {
+        path: partial(match_template_from_path, path=path, **kwargs)
+        for path in templates
+    }
+
+
+def _run_matcher(context: contextvars.Context, matcher: Callable[[np.ndarray], Iterable], image: np.ndarray) -> list:
+    # Each job runs in a copy of the caller's context, so the caller's scale calibration applies.
+    return context.run(lambda: list(matcher(image)))
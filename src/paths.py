@@ -1,3 +1,4 @@
+import re
 from pathlib import Path
 
 def mkdir(path: Path):
@@ -11,3 +12,13 @@ def _get_root():
 
 def get_sam_checkpoints():
     return mkdir(_get_root() / 'checkpoints')
+
+
+def get_calibrations():
+    return mkdir(_get_root() / 'calibrations')
+
+
+def get_calibration(serial: str | None):
+    # Network serials such as 127.0.0.1:5555 contain characters that aren't valid in file names everywhere.
+    name = re.sub(r'[^\w.-]', '_', serial or 'default')
+    return get_calibrations() / f'{name}.json'
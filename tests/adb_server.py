@@ -0,0 +1,145 @@
+import asyncio
+import os
+import signal
+from dataclasses import dataclass, field
+
+from src.lib.adb_protocol import DEFAULT_HOST
+
+
+@dataclass
+class StandInAdbServer:
+    """
+    A minimal local stand-in for the adb server that runs device commands with the host's `sh`. Useful for exercising
+    the client and shell sessions without a phone.
+    """
+    host: str = DEFAULT_HOST
+    port: int = 0
+    serial: str = 'emulator-5554'
+
+    forwards: list[tuple[str, str, str]] = field(default_factory=list)
+
+    _server: asyncio.AbstractServer | None = field(default=None, init=False, repr=False)
+    _handlers: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+
+        for handler in self._handlers:
+            handler.cancel()
+
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *_):
+        await self.stop()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+
+        try:
+            while True:
+                length = int(await reader.readexactly(4), 16)
+                request = (await reader.readexactly(length)).decode()
+
+                if not await self._handle_request(request, reader, writer):
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cancellation comes from stop(); the connection is simply dropped.
+            pass
+
+        finally:
+            self._handlers.discard(handler)
+            writer.close()
+
+    async def _handle_request(self, request: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        if request == 'host:version':
+            self._write_okay(writer, '0029')
+            return False
+
+        if request == 'host:devices':
+            self._write_okay(writer, f'{self.serial}\tdevice\n')
+            return False
+
+        if request in ('host:transport-any', f'host:transport:{self.serial}'):
+            writer.write(b'OKAY')
+            return True
+
+        if request.startswith('host:transport:'):
+            self._write_fail(writer, f"device '{request.split(':', 2)[2]}' not found")
+            return False
+
+        if ':forward:' in request:
+            serial, _, spec = request.partition(':forward:')
+            local, remote = spec.split(';', 1)
+            self.forwards.append((serial.removeprefix('host-serial:'), local, remote))
+            writer.write(b'OKAYOKAY')
+            return False
+
+        for service in ('exec:', 'shell:'):
+            if request.startswith(service):
+                writer.write(b'OKAY')
+                await self._run(request.removeprefix(service), reader, writer)
+                return False
+
+        self._write_fail(writer, f'unknown host service: {request}')
+        return False
+
+    @staticmethod
+    async def _run(command: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        process = await asyncio.create_subprocess_exec(
+            'sh', *(['-c', command] if command else []),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # The command may leave children holding stdout, so the whole group is killed when the stream ends.
+            start_new_session=True
+        )
+
+        async def pump_stdin():
+            try:
+                while chunk := await reader.read(65536):
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+
+            except ConnectionError:
+                pass
+
+            process.stdin.close()
+
+        stdin_task = asyncio.create_task(pump_stdin())
+
+        try:
+            while chunk := await process.stdout.read(65536):
+                writer.write(chunk)
+                await writer.drain()
+
+        finally:
+            stdin_task.cancel()
+
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+
+            except ProcessLookupError:
+                pass
+
+            await process.wait()
+            await writer.drain()
+
+    @staticmethod
+    def _write_okay(writer: asyncio.StreamWriter, message: str):
+        payload = message.encode()
+        writer.write(b'OKAY' + b'%04x' % len(payload) + payload)
+
+    @staticmethod
+    def _write_fail(writer: asyncio.StreamWriter, message: str):
+        payload = message.encode()
+        writer.write(b'FAIL' + b'%04x' % len(payload) + payload)
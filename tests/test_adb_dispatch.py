@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from src.lib.adb_dispatch import InputDispatcher
+from src.lib.adb_touch import TouchEvent
+
+
+def test_events_are_sent_in_order():
+    sent = []
+
+    async def send(events):
+        await asyncio.sleep(0)
+        sent.extend(events)
+
+    async def main():
+        dispatcher = InputDispatcher(send)
+        events = [TouchEvent('move', i, i) for i in range(100)]
+
+        for event in events:
+            await dispatcher.submit(event)
+
+        await dispatcher.join()
+        await dispatcher.close()
+
+        return events
+
+    assert sent == asyncio.run(main())
+
+
+def test_failed_send_is_raised_to_the_next_caller():
+    async def send(events):
+        raise ConnectionError('touch backend is gone')
+
+    async def main():
+        dispatcher = InputDispatcher(send)
+        await dispatcher.submit(TouchEvent('down', 0, 0))
+
+        with pytest.raises(ConnectionError):
+            await dispatcher.join()
+
+        # The error is reported once; later events are still sent.
+        await dispatcher.submit(TouchEvent('up', 0, 0))
+        await asyncio.sleep(0)
+
+        with pytest.raises(ConnectionError):
+            await dispatcher.submit(TouchEvent('down', 0, 0))
+
+        assert dispatcher.failed == 2
+        await dispatcher.close()
+
+    asyncio.run(main())
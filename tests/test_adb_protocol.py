@@ -0,0 +1,140 @@
+import asyncio
+import tempfile
+
+import pytest
+
+from src.lib.adb_protocol import AdbClient, AdbProtocolError
+from src.lib.adb_shell import ShellCommandError, ShellSession, ShellSessionError
+from tests.adb_server import StandInAdbServer
+
+
+def run_with_server(test):
+    async def main():
+        async with StandInAdbServer() as server:
+            return await test(server, AdbClient(port=server.port))
+
+    return asyncio.run(main())
+
+
+def open_session(client: AdbClient) -> ShellSession:
+    # The stand-in runs commands on the host, which has no /data/local/tmp.
+    return ShellSession(opener=lambda: client.open('exec:sh'), temp_dir=tempfile.gettempdir())
+
+
+def test_host_requests():
+    async def test(server, client):
+        assert await client.devices() == [(server.serial, 'device')]
+
+        await client.forward('tcp:1234', 'localabstract:scrcpy')
+        assert server.forwards == [('host', 'tcp:1234', 'localabstract:scrcpy')]
+
+    run_with_server(test)
+
+
+def test_unknown_device_fails():
+    async def test(server, client):
+        client.serial = 'missing'
+
+        with pytest.raises(AdbProtocolError, match='not found'):
+            await client.exec('true')
+
+    run_with_server(test)
+
+
+def test_shell_session_separates_consecutive_outputs():
+    async def test(server, client):
+        session = open_session(client)
+
+        try:
+            first = await session.execute('echo first; printf no-newline')
+            second = await session.execute('printf "\\n"; echo second')
+            empty = await session.execute('true')
+
+        finally:
+            await session.close()
+
+        assert (first.stdout, first.returncode) == (b'first\nno-newline', 0)
+        assert (second.stdout, second.returncode) == (b'\nsecond\n', 0)
+        assert (empty.stdout, empty.returncode) == (b'', 0)
+
+    run_with_server(test)
+
+
+def test_shell_session_exit_codes():
+    async def test(server, client):
+        session = open_session(client)
+
+        try:
+            result = await session.execute('echo oops; (exit 3)', check_error=False)
+
+            with pytest.raises(ShellCommandError) as error:
+                await session.execute('echo oops >&2; false')
+
+            # A failed command leaves the session usable.
+            after = await session.execute('echo ok')
+
+        finally:
+            await session.close()
+
+        assert (result.stdout, result.returncode) == (b'oops\n', 3)
+        assert (error.value.returncode, error.value.output, error.value.stderr) == (1, b'', b'oops\n')
+        assert after.stdout == b'ok\n'
+
+    run_with_server(test)
+
+
+def test_shell_session_separates_stderr():
+    async def test(server, client):
+        session = open_session(client)
+
+        try:
+            mixed = await session.execute('echo out; echo err >&2; printf "no newline" >&2')
+            clean = await session.execute('echo out')
+
+        finally:
+            await session.close()
+
+        assert (mixed.stdout, mixed.stderr) == (b'out\n', b'err\nno newline')
+        assert (clean.stdout, clean.stderr) == (b'out\n', b'')
+
+    run_with_server(test)
+
+
+def test_shell_session_reconnects_after_exit():
+    async def test(server, client):
+        session = open_session(client)
+
+        try:
+            with pytest.raises(ShellSessionError):
+                await session.execute('exit 5')
+
+            assert not session.is_alive
+
+            result = await session.execute('echo again')
+
+        finally:
+            await session.close()
+
+        assert (result.stdout, result.returncode) == (b'again\n', 0)
+
+    run_with_server(test)
+
+
+def test_shell_session_timeout_drops_session():
+    async def test(server, client):
+        session = open_session(client)
+
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await session.execute('sleep 5', timeout=.2)
+
+            assert not session.is_alive
+
+            result = await session.execute('echo ok')
+
+        finally:
+            await session.close()
+
+        assert result.stdout == b'ok\n'
+
+    run_with_server(test)
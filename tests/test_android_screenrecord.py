@@ -0,0 +1,72 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+av = pytest.importorskip('av')
+
+from src.lib.android_screenrecord import ScreenRecordSource, decode_file
+
+FRAME_COUNT = 10
+WIDTH, HEIGHT = 64, 48
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """
+    A raw H.264 stream like `screenrecord --output-format=h264` writes, with B-frames so the decoder holds some back.
+    """
+    codec = av.CodecContext.create('libx264', 'w')
+    codec.width, codec.height, codec.pix_fmt = WIDTH, HEIGHT, 'yuv420p'
+    codec.options = {'bf': '2'}
+
+    data = b''
+
+    for i in range(FRAME_COUNT):
+        image = np.full((HEIGHT, WIDTH, 3), i * 20, np.uint8)
+        frame = av.VideoFrame.from_ndarray(image, format='bgr24')
+        data += b''.join(bytes(packet) for packet in codec.encode(frame))
+
+    data += b''.join(bytes(packet) for packet in codec.encode(None))
+
+    path = tmp_path / 'recording.h264'
+    path.write_bytes(data)
+    return path
+
+
+def test_decode_file(recording):
+    images = list(decode_file(recording, chunk_size=256))
+
+    assert len(images) == FRAME_COUNT
+    assert all(image.shape == (HEIGHT, WIDTH, 3) for image in images)
+    assert [round(image.mean() / 20) for image in images] == list(range(FRAME_COUNT))
+
+
+class FakeAdb:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.recordings = 0
+
+    async def stream(self, command: str, chunk_size: int):
+        self.recordings += 1
+
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+
+def test_screenrecord_source_flushes_each_recording(recording):
+    adb = FakeAdb(recording.read_bytes())
+
+    async def first_recording():
+        frames = []
+
+        async for frame in ScreenRecordSource(adb, chunk_size=256).frames():
+            frames.append(frame)
+
+            if len(frames) == FRAME_COUNT:
+                return frames
+
+    frames = asyncio.run(first_recording())
+
+    assert adb.recordings == 1
+    assert [frame.index for frame in frames] == list(range(1, FRAME_COUNT + 1))